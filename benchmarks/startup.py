@@ -0,0 +1,167 @@
+#!/usr/bin/python
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+"""Measure mdvpkgd cold start on a private session bus.
+
+For each run a new daemon is started and the time from its exec to
+owning the mdvpkg bus name, and to its first method reply, are
+measured.  The exit status is 1 if the median time to the first reply
+is above the target.
+
+Usage: startup.py [options] [-- daemon command]
+"""
+
+
+import os
+import sys
+import time
+import subprocess
+from optparse import OptionParser
+
+import dbus
+import dbus.bus
+
+SOURCE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                          os.pardir))
+sys.path.insert(0, SOURCE_DIR)
+import mdvpkg
+
+
+## Interval between checks for the daemon bus name (seconds)
+POLL_INTERVAL = 0.001
+
+
+def start_bus():
+    """Start a private session bus, returning (process, address)."""
+    proc = subprocess.Popen(['dbus-daemon',
+                             '--session',
+                             '--nofork',
+                             '--print-address=1'],
+                            stdout=subprocess.PIPE)
+    address = proc.stdout.readline().strip()
+    if not address:
+        proc.wait()
+        raise RuntimeError('dbus-daemon failed to start')
+    return proc, address
+
+
+def daemon_command():
+    """Run the daemon of this source tree, on the session bus, without
+    starting the backend nor using a cache snapshot.
+    """
+    backend = os.path.join(SOURCE_DIR, 'mdvpkg', 'backend',
+                           'urpmi_backend.pl')
+    return [sys.executable, '-m', 'mdvpkg.daemon',
+            '--session',
+            '--backend', backend,
+            '--lazy-backend',
+            '--snapshot-file', '']
+
+
+def measure(address, command, timeout):
+    """Start the daemon once, returning the times (seconds) to own its
+    bus name and to reply to GetStats().
+    """
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+    env['PYTHONPATH'] = os.pathsep.join(
+                            filter(None, [SOURCE_DIR,
+                                          env.get('PYTHONPATH')])
+                        )
+    bus = dbus.bus.BusConnection(address)
+    devnull = open(os.devnull, 'w')
+    started = time.time()
+    daemon = subprocess.Popen(command, env=env,
+                              stdout=devnull,
+                              stderr=devnull)
+    try:
+        while not bus.name_has_owner(mdvpkg.DBUS_SERVICE):
+            if daemon.poll() is not None:
+                raise RuntimeError('daemon exited with status %s'
+                                   % daemon.returncode)
+            if time.time() - started > timeout:
+                raise RuntimeError('daemon did not start in %ss' % timeout)
+            time.sleep(POLL_INTERVAL)
+        owned = time.time() - started
+        proxy = bus.get_object(mdvpkg.DBUS_SERVICE, mdvpkg.DBUS_PATH)
+        proxy.GetStats(dbus_interface=mdvpkg.DBUS_INTERFACE)
+        replied = time.time() - started
+    finally:
+        if daemon.poll() is None:
+            daemon.terminate()
+            daemon.wait()
+        devnull.close()
+        bus.close()
+    return owned, replied
+
+
+def summary(name, values):
+    values = sorted(values)
+    print '%-12s min %7.1f ms  median %7.1f ms  max %7.1f ms' \
+          % (name,
+             values[0] * 1000,
+             values[len(values) / 2] * 1000,
+             values[-1] * 1000)
+    return values[len(values) / 2]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [-- daemon command]')
+    parser.add_option('-n', '--runs',
+                      default=10,
+                      type='int',
+                      dest='runs',
+                      help='Number of daemon starts (default: %default).')
+    parser.add_option('--target',
+                      default=300,
+                      type='float',
+                      dest='target',
+                      help='Maximum median time to the first reply '
+                           '(milliseconds, default: %default).')
+    parser.add_option('--timeout',
+                      default=30,
+                      type='float',
+                      dest='timeout',
+                      help='Maximum time to wait for each start '
+                           '(seconds, default: %default).')
+    opts, args = parser.parse_args()
+    command = args or daemon_command()
+
+    bus_proc, address = start_bus()
+    try:
+        owned = []
+        replied = []
+        for i in xrange(opts.runs):
+            (owned_time, replied_time) = measure(address, command,
+                                                 opts.timeout)
+            owned.append(owned_time)
+            replied.append(replied_time)
+    finally:
+        bus_proc.terminate()
+        bus_proc.wait()
+
+    summary('name owned', owned)
+    median = summary('first reply', replied)
+    if median * 1000 > opts.target:
+        print 'median time to the first reply above %d ms' % opts.target
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
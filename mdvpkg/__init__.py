@@ -30,3 +30,10 @@ DBUS_PATH = '/'
 
 DBUS_TASK_PATH = '%stask' % DBUS_PATH
 DBUS_TASK_INTERFACE = '%s.task' % DBUS_INTERFACE
+
+## Defaults of daemon options, kept here so that the daemon doesn't
+## import the subsystems using them just to parse its options:
+DEFAULT_PROGRESS_RATE = 10
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_SNAPSHOT_PATH = '/var/cache/mdvpkg/cache-snapshot'
+DEFAULT_FILE_INDEX_DIR = '/var/cache/mdvpkg/files'
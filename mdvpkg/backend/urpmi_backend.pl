@@ -32,6 +32,9 @@ use urpm::media qw();
 use urpm::args qw();
 use urpm::select qw();
 use urpm::main_loop qw();
+use JSON::PP qw();
+
+use constant PROTOCOL_VERSION => 1;
 
 use constant {
     STATE_SOLVING => 'state-resolving',
@@ -40,10 +43,16 @@ use constant {
     STATE_SEARCHING => 'state-searching',
 };
 
-$| = 1;
+# Frames are written to a dup of the original stdout, while anything
+# else printed by urpmi goes to stderr and can't corrupt them:
+open(my $PROTO, '>&', \*STDOUT) or die "Can't dup stdout: $!\n";
+open(STDOUT, '>&', \*STDERR) or die "Can't redirect stdout: $!\n";
+binmode $PROTO, ':raw';
+binmode STDIN, ':raw';
+$PROTO->autoflush(1);
+STDOUT->autoflush(1);
 
-binmode STDOUT, ':encoding(utf8)';
-binmode STDIN, ':encoding(utf8)';
+my $json = JSON::PP->new->ascii;
 
 our $read_tasks = 1;
 $SIG{TERM} = sub {
@@ -52,13 +61,27 @@ $SIG{TERM} = sub {
 
 MAIN: {
     # Initializing urpmi ...
-    my $urpm = urpm->new_parse_cmdline;
-    urpm::media::configure($urpm);
+    task_response('HELLO', int => PROTOCOL_VERSION);
+    my $urpm = urpm_init();
+    task_ready();
 
-    while ($read_tasks and defined(my $task_string = <>)) {
-	chomp($task_string);
-	my ($name, @args) = split(/\t/, $task_string);
+    while ($read_tasks and defined(my $command = read_frame())) {
+	my ($name, @args) = ($command->{task}, @{ $command->{args} || [] });
 	eval {
+	    if ($name eq 'hello') {
+		if ($args[0] != PROTOCOL_VERSION) {
+		    print STDERR "Unsupported protocol version: $args[0]\n";
+		    exit 1;
+		}
+		return 1;
+	    }
+	    if ($name eq 'reload') {
+		# Media configuration has changed, configure a new urpm
+		# object ...
+		$urpm = urpm_init();
+		task_ready();
+		return 1;
+	    }
 	    my $task_func = "on_task__$name";
 	    defined $main::{$task_func} 
 	        or die "Unknown task name: '$name'\n";
@@ -72,6 +95,43 @@ MAIN: {
     }
 }
 
+sub urpm_init {
+    my $urpm = urpm->new_parse_cmdline;
+    urpm::media::configure($urpm);
+    return $urpm;
+}
+
+#
+# Protocol framing
+#
+
+sub read_frame {
+    # Read a netstring frame from stdin and decode its JSON data,
+    # returns undef on end of file.
+    my $length = '';
+    my $c;
+    while (1) {
+	read(STDIN, $c, 1) or return undef;
+	last if $c eq ':';
+	$c =~ /\d/ or die "Malformed frame length\n";
+	$length .= $c;
+    }
+    my $data = '';
+    while (length($data) < $length) {
+	read(STDIN, $data, $length - length($data), length($data))
+	    or die "Truncated frame\n";
+    }
+    read(STDIN, $c, 1) and $c eq ','
+	or die "Missing frame terminator\n";
+    return $json->decode($data);
+}
+
+sub write_frame {
+    my ($message) = @_;
+    my $data = $json->encode($message);
+    print $PROTO length($data), ':', $data, ',';
+}
+
 #
 # Backend responses
 #
@@ -81,24 +141,27 @@ sub task_response {
 
     my %value_converters = (
 	'bool' => sub {
-	    return $_[0] ? 'True' : 'False';
+	    return $_[0] ? JSON::PP::true : JSON::PP::false;
 	},
 	'str' => sub {
-	    $_[0] =~ s|'|\\'|g;
-	    return "'" . $_[0] . "'";
+	    return defined $_[0] ? "$_[0]" : '';
 	},
 	'int' => sub {
-	    $_[0] =~ /\d+/ or die "$_[0] is not a number\n";
+	    $_[0] =~ /^-?\d+$/ or die "$_[0] is not a number\n";
+	    return 0 + $_[0];
+	},
+	# lists and hashes already holding typed values:
+	'data' => sub {
 	    return $_[0];
 	},
     );
 
-    my $args_str = '';
+    my @values;
     while (my $type = shift @args) {
-	$args_str .= $value_converters{$type}->(shift @args) . ', ';
+	push @values, $value_converters{$type}->(shift @args);
     }
 
-    printf("\n%s\t%s\t(%s)\n", '%MDVPKG', $tag, $args_str);
+    write_frame({ tag => $tag, args => \@values });
 }
 
 sub task_signal {
@@ -125,6 +188,10 @@ sub task_done {
     task_response('DONE');
 }
 
+sub task_ready {
+    task_response('READY');
+}
+
 #
 # Task Handlers
 #
@@ -272,63 +339,64 @@ sub on_task__install_packages {
     );    
 }
 
-sub on_task__search_files {
-    my ($urpm, @files) = @_;
-    
-    # For each medium, we browse the xml info file, while looking for
-    # files which matched with the search term given in argument. We
-    # store results in a hash ...
-
-    my %results;
-    my %args;
-    foreach my $medium (urpm::media::non_ignored_media($urpm)) {
-	my $xml_info_file = urpm::media::any_xml_info(
-	                        $urpm,
-	                        $medium,
-	                        qw( files summary ),
-	                        undef,
-	                        \&search_files_sync_logger_callback
-	                    );
-	$xml_info_file or next;
-
-	require urpm::xml_info;
-	require urpm::xml_info_pkg;
-
-	my $F = urpm::xml_info::open_lzma($xml_info_file);
-	my $fn;
-	local $_;
-	my @files = ();
-	while (<$F>) {
-	    chomp;
-	    if (/<files/) {
-		($fn) = /fn="(.*)"/;
-	    } 
-	    elsif (/^$args{pattern}$/ or ($args{fuzzy} and /$args{pattern}/)) {
-		my $xml_pkg = urpm::xml_info_pkg->new({ fn => $fn });
-		if (not exists $results{$fn}) {
-		    $results{$fn} = { pkg => $xml_pkg,
-				      files => [] };
-		}
-		push @{ $results{$fn}{files} }, $_;
-	    }
-	}
-    }
+sub on_task__install_verified_packages {
+    my ($urpm, @names) = @_;
+
+    # Packages were verified by the daemon as they were downloaded,
+    # with the keys of their medias:
+    local $urpm->{options}{'verify-rpm'} = 0;
+    on_task__install_packages($urpm, @names);
+}
 
-    foreach my $fn (keys %results) {
-	my $xml_pkg = $results{$fn}{pkg};
-	my $py_str = sprintf("{'name': %s, "
-			         . "'version': %s, "
-			         . "'release': %s, " 
-			         . "'arch': %s, "
-			         . "'files': [",
-			     py_str($xml_pkg->name),
-			     py_str($xml_pkg->version),
-			     py_str($xml_pkg->release),
-			     py_str($xml_pkg->arch));
-	$py_str .= sprintf('%s, ', py_str($_)) for (@{ $results{$fn}{files} });
-	$py_str .= ']}';
-	task_signal('PackageFiles', $py_str)
+sub on_task__resolve_packages {
+    my ($urpm, @names) = @_;
+
+    @names or die "Missing package names to resolve\n";
+
+    task_state_changed(STATE_SEARCHING);
+    my %packages;
+    urpm::select::search_packages(
+	$urpm,
+	\%packages,
+	\@names,
+    );
+
+    task_state_changed(STATE_SOLVING);
+    my $state = {};
+    urpm::select::resolve_dependencies(
+	$urpm,
+	$state,
+	\%packages,
+	auto_select => 0,
+    );
+
+    my @install;
+    foreach my $id (sort { $a <=> $b } keys %{ $state->{selected} }) {
+	my $pkg = $urpm->{depslist}[$id];
+	# Packages from remote medias may be downloaded by the daemon
+	# into urpmi cache, where urpmi looks for them before
+	# downloading:
+	my $medium = urpm::pkg2media($urpm->{media}, $pkg);
+	my $url = '';
+	if ($medium and $medium->{url}
+	    and not urpm::is_local_medium($medium)) {
+	    $url = "$medium->{url}/" . $pkg->filename;
+	}
+	# Keys allowed to sign packages of the media:
+	my @key_ids = $medium ? split(/[,\s]+/, $medium->{'key-ids'} || '')
+	                      : ();
+	push @install, { name => scalar($pkg->name),
+			 version => scalar($pkg->version),
+			 release => scalar($pkg->release),
+			 arch => scalar($pkg->arch),
+			 filesize => 0 + ($pkg->filesize || 0),
+			 size => 0 + ($pkg->size || 0),
+			 url => $url,
+			 key_ids => \@key_ids,
+			 path => "$urpm->{cachedir}/rpms/" . $pkg->filename };
     }
+    my @remove = map { "$_" } urpm::select::removed_packages($state);
 
-    return 'exit-success';
+    task_response('RESULT', data => \@install, data => \@remove);
+    task_done();
 }
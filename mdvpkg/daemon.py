@@ -22,6 +22,7 @@
 """Main daemon class and running script."""
 
 
+import os
 import logging
 import logging.handlers
 import sys
@@ -31,13 +32,21 @@ import dbus.mainloop.glib
 import dbus.service
 import gobject
 import signal 
+import time
 
 import mdvpkg
-import mdvpkg.urpmi.db
-import mdvpkg.tasks
-import mdvpkg.worker
+import mdvpkg.results
+import mdvpkg.stats
+import mdvpkg.profiling
+import mdvpkg.exceptions
+# The task, urpmi database and worker modules (with rpm and pyinotify)
+# are imported when first used, so that the daemon owns its bus name
+# as soon as possible when started by D-Bus activation.
 
 
+## Interval between checks for idle exit (seconds)
+IDLE_CHECK_INTERVAL = 10
+
 log = logging.getLogger('mdvpkgd')
 # setup default dbus mainloop:
 dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -47,7 +56,17 @@ class MdvPkgDaemon(dbus.service.Object):
     """Represents the daemon, which provides the dbus interface (by
     default at the system bus)."""
 
-    def __init__(self, bus=None, backend_path=None):
+    def __init__(self, bus=None, backend_path=None,
+                 cache_budget=mdvpkg.results.DEFAULT_BUDGET,
+                 cache_expiry=mdvpkg.results.DEFAULT_EXPIRY,
+                 prestart_backend=True,
+                 progress_rate=mdvpkg.DEFAULT_PROGRESS_RATE,
+                 merge_installs=False,
+                 download_workers=0,
+                 verify_workers=None,
+                 idle_timeout=0,
+                 snapshot_path=None,
+                 file_index_dir=mdvpkg.DEFAULT_FILE_INDEX_DIR):
         log.info('Starting daemon')
 
         signal.signal(signal.SIGQUIT, self._quit_handler)
@@ -60,18 +79,74 @@ class MdvPkgDaemon(dbus.service.Object):
             backend_path = mdvpkg.DEFAULT_BACKEND_PATH
         self._loop = gobject.MainLoop()
         try:
-            bus_name = dbus.service.BusName(mdvpkg.DBUS_SERVICE,
-                                            self.bus,
-                                            do_not_queue=True)
+            self.bus_name = dbus.service.BusName(mdvpkg.DBUS_SERVICE,
+                                                 self.bus,
+                                                 do_not_queue=True)
         except dbus.exceptions.NameExistsException:
             log.critical('Someone is using %s service name...',
                          mdvpkg.DBUS_SERVICE)
             sys.exit(1)
-        dbus.service.Object.__init__(self, bus_name, mdvpkg.DBUS_PATH)
-        self.urpmi = mdvpkg.urpmi.db.UrpmiDB()
-        self.runner = mdvpkg.worker.Runner(self.urpmi, backend_path)
+        dbus.service.Object.__init__(self, self.bus_name, mdvpkg.DBUS_PATH)
+        self.results = mdvpkg.results.ResultCache(cache_budget, cache_expiry)
+        self._snapshot_path = snapshot_path
+        self._file_index_dir = file_index_dir
+        self._backend_path = backend_path
+        self._runner_options = {'progress_rate': progress_rate,
+                                'merge_tasks': merge_installs,
+                                'download_workers': download_workers,
+                                'verify_workers': verify_workers}
+        # subsystems, created on first use (see above):
+        self._tasks = None
+        self._urpmi = None
+        self._files = None
+        self._runner = None
+        if prestart_backend:
+            # start it once the bus name is served:
+            gobject.idle_add(self._prestart_backend)
+        self._started = time.time()
+        self._idle_timeout = idle_timeout
+        if idle_timeout:
+            gobject.timeout_add_seconds(min(IDLE_CHECK_INTERVAL,
+                                            idle_timeout),
+                                        self._check_idle)
         log.info('Daemon is ready')
 
+    @property
+    def tasks(self):
+        """Task paths and sender watches, shared by all tasks."""
+        if self._tasks is None:
+            import mdvpkg.tasks
+            self._tasks = mdvpkg.tasks.TaskRegistry(self.bus)
+        return self._tasks
+
+    @property
+    def urpmi(self):
+        """The urpmi database and package cache."""
+        if self._urpmi is None:
+            import mdvpkg.urpmi.db
+            self._urpmi = mdvpkg.urpmi.db.UrpmiDB(
+                              snapshot_path=self._snapshot_path
+                          )
+        return self._urpmi
+
+    @property
+    def files(self):
+        """File indexes of medias, for file searches."""
+        if self._files is None:
+            import mdvpkg.urpmi.files
+            self._files = mdvpkg.urpmi.files.FileIndexes(self._file_index_dir)
+        return self._files
+
+    @property
+    def runner(self):
+        """The task runner, with the urpmi backend."""
+        if self._runner is None:
+            import mdvpkg.worker
+            self._runner = mdvpkg.worker.Runner(self.urpmi,
+                                                self._backend_path,
+                                                **self._runner_options)
+        return self._runner
+
     def run(self):
         try:
             self._loop.run()
@@ -84,7 +159,7 @@ class MdvPkgDaemon(dbus.service.Object):
                          sender_keyword='sender')
     def ListMedias(self, sender):
         log.info('ListMedias() called')
-        return self._create_task(mdvpkg.tasks.ListMediasTask,
+        return self._create_task('ListMediasTask',
                                  sender)
         
     @dbus.service.method(mdvpkg.DBUS_INTERFACE,
@@ -93,28 +168,106 @@ class MdvPkgDaemon(dbus.service.Object):
                          sender_keyword='sender')
     def ListGroups(self, sender):
         log.info('ListGroups() called')
-        return self._create_task(mdvpkg.tasks.ListGroupsTask,
+        return self._create_task('ListGroupsTask',
                                  sender)
 
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='a(sbb)')
+    def GetMedias(self):
+        """Return the list of (name, update, ignore) of the known
+        medias, without creating a task.
+        """
+        log.info('GetMedias() called')
+        return dbus.Array([ (media.name, media.update, media.ignore)
+                                for media in self.urpmi.list_medias() ],
+                          signature='(sbb)')
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='a(su)')
+    def GetGroups(self):
+        """Return the list of (group, package count) of all package
+        groups, without creating a task.
+        """
+        log.info('GetGroups() called')
+        return dbus.Array(self.urpmi.list_groups(), signature='(su)')
+
     @dbus.service.method(mdvpkg.DBUS_INTERFACE,
                          in_signature='as',
                          out_signature='o',
                          sender_keyword='sender')
     def ListPackages(self, attributes, sender):
         log.info('ListPackages() called')
-        return self._create_task(mdvpkg.tasks.ListPackagesTask,
+        return self._create_task('ListPackagesTask',
+                                 sender,
+                                 attributes)
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='a{sv}asa{sv}',
+                         out_signature='o',
+                         sender_keyword='sender')
+    def QueryPackages(self, filters, attributes, options, sender):
+        """Create a ListPackages task with filters and options, and
+        run it.
+
+        Clients must listen to task signals before calling it, since
+        the task may start emitting them right after the reply.
+        """
+        log.info('QueryPackages() called')
+        import mdvpkg.tasks
+        filters, options = mdvpkg.tasks.check_query(filters, options)
+        task = mdvpkg.tasks.ListPackagesTask(self,
+                                             sender,
+                                             self.runner,
+                                             attributes)
+        task.set_filters(filters)
+        if options.get('cached'):
+            task.set_cached()
+        self.runner.push(task)
+        return task.path
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='uas',
+                         out_signature='o',
+                         sender_keyword='sender')
+    def ListChanges(self, generation, attributes, sender):
+        log.info('ListChanges() called')
+        return self._create_task('ListChangesTask',
                                  sender,
+                                 generation,
                                  attributes)
 
-    # @dbus.service.method(mdvpkg.DBUS_INTERFACE,
-    #                      in_signature='as',
-    #                      out_signature='o',
-    #                      sender_keyword='sender')
-    # def SearchFiles(self, files, sender):
-    #     log.info('SearchFiles() called: %s', files)
-    #     return self._create_task(mdvpkg.tasks.SearchFilesTask,
-    #                              sender,
-    #                              files)
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='s',
+                         out_signature='o',
+                         sender_keyword='sender')
+    def AggregatePackages(self, key, sender):
+        log.info('AggregatePackages() called')
+        return self._create_task('AggregatePackagesTask',
+                                 sender,
+                                 key)
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='as',
+                         out_signature='o',
+                         sender_keyword='sender')
+    def SearchFiles(self, files, sender):
+        log.info('SearchFiles() called: %s', files)
+        return self._create_task('SearchFilesTask',
+                                 sender,
+                                 files)
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='sas',
+                         out_signature='o',
+                         sender_keyword='sender')
+    def SearchText(self, query, attributes, sender):
+        log.info('SearchText() called: %s', query)
+        return self._create_task('SearchTextTask',
+                                 sender,
+                                 query,
+                                 attributes)
 
     @dbus.service.method(mdvpkg.DBUS_INTERFACE,
                          in_signature='as',
@@ -122,10 +275,105 @@ class MdvPkgDaemon(dbus.service.Object):
                          sender_keyword='sender')
     def InstallPackages(self, names, sender):
         log.info('InstallPackages() called')
-        return self._create_task(mdvpkg.tasks.InstallPackagesTask,
+        return self._create_task('InstallPackagesTask',
+                                 sender,
+                                 names)
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='as',
+                         out_signature='o',
+                         sender_keyword='sender')
+    def ResolvePackages(self, names, sender):
+        log.info('ResolvePackages() called')
+        return self._create_task('ResolvePackagesTask',
                                  sender,
                                  names)
 
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='a{sv}')
+    def GetStats(self):
+        """Return daemon metrics: counters (integers) and histograms
+        of durations in seconds (floats).
+        """
+        stats = mdvpkg.stats.snapshot()
+        for (key, value) in self.results.stats().iteritems():
+            stats['results.%s' % key] = value
+        # subsystems not used yet are not loaded for this:
+        if self._runner is not None:
+            stats.update({'runner.queued': len(self._runner.queue),
+                          'runner.read_queued': len(self._runner.read_queue),
+                          'runner.readers': len(self._runner.readers)})
+        if self._tasks is not None:
+            stats['tasks.alive'] = len(self._tasks)
+        if self._urpmi is not None:
+            stats['cache.generation'] = self._urpmi.generation
+        metrics = dbus.Dictionary(signature='sv')
+        for (key, value) in stats.iteritems():
+            if isinstance(value, float):
+                metrics[key] = dbus.Double(value)
+            else:
+                metrics[key] = dbus.UInt64(value)
+        return metrics
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='aa{sv}')
+    def GetCacheTraces(self):
+        """Return the traces of the last package cache updates, oldest
+        first.
+        """
+        traces = []
+        if self._urpmi is None:
+            return dbus.Array(traces, signature='a{sv}')
+        for trace in self._urpmi.traces:
+            phases = [ dbus.Dictionary({'phase': phase['phase'],
+                                        'media': phase['media'],
+                                        'duration':
+                                            dbus.Double(phase['duration']),
+                                        'items': dbus.UInt32(phase['items'])},
+                                       signature='sv')
+                           for phase in trace.phases ]
+            traces.append(
+                dbus.Dictionary({'started': dbus.Double(trace.started),
+                                 'duration': dbus.Double(trace.duration),
+                                 'generation': dbus.UInt64(trace.generation),
+                                 'packages': dbus.UInt32(trace.packages),
+                                 'phases': dbus.Array(phases,
+                                                      signature='a{sv}')},
+                                signature='sv')
+            )
+        return dbus.Array(traces, signature='a{sv}')
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='b',
+                         out_signature='',
+                         sender_keyword='sender')
+    def SetProfiling(self, enabled, sender):
+        """Start or stop profiling the daemon work."""
+        uid = self.bus.get_unix_user(sender)
+        if uid not in (0, os.getuid()):
+            raise mdvpkg.exceptions.NotAuthorized(
+                      'only administrators can change profiling'
+                  )
+        try:
+            mdvpkg.profiling.set_enabled(enabled)
+        except EnvironmentError as e:
+            log.error('failed to enable profiling: %s', e)
+            raise mdvpkg.exceptions.MdvPkgError(str(e))
+
+    @dbus.service.method(mdvpkg.DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='a{sv}')
+    def GetCachedStats(self):
+        """Return statistics of task results cached for clients."""
+        stats = self.results.stats()
+        return dbus.Dictionary(
+                   [ (key, dbus.UInt64(value))
+                         for (key, value) in stats.iteritems() ],
+                   signature='sv'
+               )
+
     @dbus.service.method(mdvpkg.DBUS_INTERFACE,
                          in_signature='',
                          out_signature='',
@@ -133,13 +381,40 @@ class MdvPkgDaemon(dbus.service.Object):
     def Quit(self, sender):
         """Request a shutdown of the service."""
         log.info('Shutdown was requested')
+        if self._runner is not None:
+            self._runner.stop_backend()
+        if self._snapshot_path and self._urpmi is not None:
+            self._urpmi.save_snapshot(self._snapshot_path)
         log.debug('Quitting main loop...')
         self._loop.quit()
 
-    def _create_task(self, task_class, sender, *args):
+    def _create_task(self, task_name, sender, *args):
+        import mdvpkg.tasks
+        task_class = getattr(mdvpkg.tasks, task_name)
         task = task_class(self, sender, self.runner, *args)
         return task.path
 
+    def _prestart_backend(self):
+        self.runner.start_backend()
+        return False
+
+    def _check_idle(self):
+        """Quit if there were no tasks for the idle timeout (the
+        daemon is started again by D-Bus activation).
+        """
+        if self._tasks is None:
+            idle_since = self._started
+        elif self._tasks:
+            return True
+        else:
+            idle_since = self._tasks.idle_since
+        idle = time.time() - idle_since
+        if idle < self._idle_timeout:
+            return True
+        log.info('idle for %d seconds, exiting', idle)
+        self.Quit(None)
+        return False
+
     def _quit_handler(self, signum, frame):
         """Handler for quiting signals."""
         self.Quit(None)
@@ -187,6 +462,84 @@ def run():
                       action='store',
                       dest='backend',
                       help='Path to the urpmi backend to use.')
+    parser.add_option('--lazy-backend',
+                      default=False,
+                      action='store_true',
+                      dest='lazy_backend',
+                      help='Start the urpmi backend only when a task needs '
+                           'it (instead of keeping it running).')
+    parser.add_option('--cache-budget',
+                      default=mdvpkg.results.DEFAULT_BUDGET / 2**20,
+                      type='int',
+                      dest='cache_budget',
+                      help='Memory budget for results cached for clients '
+                           '(MiB).')
+    parser.add_option('--cache-expiry',
+                      default=mdvpkg.results.DEFAULT_EXPIRY,
+                      type='int',
+                      dest='cache_expiry',
+                      help='Time to keep cached results not accessed by '
+                           'clients (seconds).')
+    parser.add_option('--progress-rate',
+                      default=mdvpkg.DEFAULT_PROGRESS_RATE,
+                      type='float',
+                      dest='progress_rate',
+                      help='Maximum progress signals per second for each '
+                           'file or package (0 to disable).')
+    parser.add_option('--merge-installs',
+                      default=False,
+                      action='store_true',
+                      dest='merge_installs',
+                      help='Run queued install tasks together in a single '
+                           'urpmi transaction.')
+    parser.add_option('--download-workers',
+                      default=0,
+                      type='int',
+                      dest='download_workers',
+                      help='Download packages to install with this many '
+                           'concurrent downloads, instead of letting urpmi '
+                           'download them one at a time (e.g. %d).'
+                           % mdvpkg.DEFAULT_DOWNLOAD_WORKERS)
+    parser.add_option('--verify-workers',
+                      default=None,
+                      type='int',
+                      dest='verify_workers',
+                      help='Concurrent signature checks of packages '
+                           'downloaded by the daemon (default: one per '
+                           'processor, 0 to leave them to urpmi).')
+    parser.add_option('--profile',
+                      default=False,
+                      action='store_true',
+                      dest='profile',
+                      help='Profile cache updates, tasks and backend '
+                           'replies (can be changed with SetProfiling()).')
+    parser.add_option('--profile-dir',
+                      default=mdvpkg.profiling.DEFAULT_DIRECTORY,
+                      dest='profile_dir',
+                      help='Directory of profile dumps (default: %default).')
+    parser.add_option('--profile-threshold',
+                      default=mdvpkg.profiling.DEFAULT_THRESHOLD,
+                      type='float',
+                      dest='profile_threshold',
+                      help='Only dump profiles of work taking at least '
+                           'this time (seconds).')
+    parser.add_option('--idle-timeout',
+                      default=0,
+                      type='int',
+                      dest='idle_timeout',
+                      help='Exit after this time without tasks (seconds, '
+                           '0 to never exit).')
+    parser.add_option('--snapshot-file',
+                      default=mdvpkg.DEFAULT_SNAPSHOT_PATH,
+                      dest='snapshot_path',
+                      help='Save the package cache to this file on exit, '
+                           'to restore it on startup if still valid (empty '
+                           'to disable, default: %default).')
+    parser.add_option('--file-index-dir',
+                      default=mdvpkg.DEFAULT_FILE_INDEX_DIR,
+                      dest='file_index_dir',
+                      help='Directory of the media file indexes used by '
+                           'SearchFiles() (default: %default).')
     opts, args = parser.parse_args()
 
     ## Setup daemon and run ...
@@ -199,7 +552,25 @@ def run():
     else:
         log.setLevel(logging.INFO)
 
-    d = MdvPkgDaemon(bus=bus, backend_path=opts.backend)
+    mdvpkg.profiling.configure(opts.profile_dir, opts.profile_threshold)
+    if opts.profile:
+        try:
+            mdvpkg.profiling.set_enabled(True)
+        except EnvironmentError as e:
+            log.error('failed to enable profiling: %s', e)
+
+    d = MdvPkgDaemon(bus=bus,
+                     backend_path=opts.backend,
+                     cache_budget=opts.cache_budget * 2**20,
+                     cache_expiry=opts.cache_expiry,
+                     prestart_backend=not opts.lazy_backend,
+                     progress_rate=opts.progress_rate,
+                     merge_installs=opts.merge_installs,
+                     download_workers=opts.download_workers,
+                     verify_workers=opts.verify_workers,
+                     idle_timeout=opts.idle_timeout,
+                     snapshot_path=opts.snapshot_path or None,
+                     file_index_dir=opts.file_index_dir)
     d.run()
 
 
@@ -0,0 +1,192 @@
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): J. Victor Martins <jvdm@mandriva.com>
+##
+"""Concurrent download of package files."""
+
+
+import os
+import time
+import logging
+import threading
+import Queue
+import urllib2
+import gobject
+
+import mdvpkg
+
+
+## Default number of concurrent downloads
+DEFAULT_WORKERS = mdvpkg.DEFAULT_DOWNLOAD_WORKERS
+## Size of blocks read from connections (bytes)
+BLOCK_SIZE = 64 * 1024
+## Minimum interval between progress reports of a file (seconds)
+PROGRESS_INTERVAL = 0.5
+## Connection timeout (seconds)
+TIMEOUT = 60
+
+log = logging.getLogger('mdvpkgd.download')
+
+
+class DownloadCanceled(Exception):
+    pass
+
+
+def is_downloaded(path, size):
+    """Check if a file was already downloaded to path."""
+    return os.path.isfile(path) and os.path.getsize(path) == size
+
+
+class Downloader(object):
+    """Download files with a bounded pool of worker threads.
+
+    Workers are started on demand and shared by all downloads, so
+    there are at most `workers` connections open at any time.  URLs
+    are opened with urllib2, so http://, ftp:// and file:// URLs are
+    supported.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        # workers report to the main loop through idle callbacks:
+        gobject.threads_init()
+
+    def fetch(self, files, listener):
+        """Start downloading files, a list of (url, path, size)
+        tuples.  Files already at path with the expected size are
+        skipped.
+
+        listener's download_start(name), download_progress(name,
+        done, total, speed), download_done(name), download_error(name,
+        message) and downloads_finished(failed) methods are called in
+        the main loop, where name is the base name of path and failed
+        the list of names which could not be downloaded.  Return a
+        Download object.
+        """
+        pending = []
+        for (url, path, size) in files:
+            if is_downloaded(path, size):
+                log.debug('already downloaded: %s', path)
+            else:
+                pending.append((url, path, size))
+        download = Download(listener, len(pending))
+        if not pending:
+            gobject.idle_add(download.finish)
+        for file in pending:
+            self._queue.put((download, file))
+        self._threads = [ t for t in self._threads if t.is_alive() ]
+        while (len(self._threads) < self.workers
+                   and len(self._threads) < self._queue.qsize()):
+            thread = threading.Thread(target=self._work,
+                                      name='download-worker')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return download
+
+    def _work(self):
+        """Worker thread loop."""
+        while True:
+            (download, file) = self._queue.get()
+            try:
+                download.fetch_file(*file)
+            except Exception:
+                log.exception('download worker failed')
+
+
+class Download(object):
+    """A set of files being downloaded for a listener."""
+
+    def __init__(self, listener, count):
+        self.canceled = False
+        self.failed = []
+        self._listener = listener
+        self._pending = count
+
+    def cancel(self):
+        """Stop downloading, remaining files are reported as
+        failed.
+        """
+        self.canceled = True
+
+    def finish(self):
+        self._listener.downloads_finished(self.failed)
+
+    def fetch_file(self, url, path, size):
+        """Download a file (called in a worker thread)."""
+        name = os.path.basename(path)
+        part = path + '.part'
+        try:
+            if self.canceled:
+                raise DownloadCanceled('download canceled')
+            self._notify(self._listener.download_start, name)
+            connection = urllib2.urlopen(url, timeout=TIMEOUT)
+            try:
+                with open(part, 'wb') as output:
+                    self._copy(connection, output, name, size)
+            finally:
+                connection.close()
+            os.rename(part, path)
+        except (EnvironmentError, DownloadCanceled) as e:
+            log.warning('download failed: %s: %s', url, e)
+            if os.path.exists(part):
+                os.unlink(part)
+            self._notify(self._file_failed, name, str(e))
+        else:
+            self._notify(self._file_done, name)
+
+    def _copy(self, connection, output, name, size):
+        done = 0
+        start = last_report = time.time()
+        while True:
+            if self.canceled:
+                raise DownloadCanceled('download canceled')
+            block = connection.read(BLOCK_SIZE)
+            if not block:
+                break
+            output.write(block)
+            done += len(block)
+            now = time.time()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                speed = done / max(now - start, 0.001)
+                self._notify(self._listener.download_progress,
+                             name, done, size, speed)
+        if size and done != size:
+            raise IOError('expected %s bytes, got %s' % (size, done))
+
+    def _notify(self, callback, *args):
+        gobject.idle_add(callback, *args)
+
+    def _file_done(self, name):
+        self._listener.download_done(name)
+        self._file_finished()
+
+    def _file_failed(self, name, message):
+        self.failed.append(name)
+        self._listener.download_error(name, message)
+        self._file_finished()
+
+    def _file_finished(self):
+        self._pending -= 1
+        if self._pending == 0:
+            self.finish()
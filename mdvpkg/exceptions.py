@@ -28,7 +28,8 @@ import dbus
 class MdvPkgError(dbus.DBusException):
     """Base error class for mdvpkg."""
 
-    def __init__(self):
+    def __init__(self, *args):
+        dbus.DBusException.__init__(self, *args)
         name = self.__class__.__name__
         self._dbus_error_name = 'org.mandrivalinux.mdvpkg.%s' % name
 
@@ -43,3 +44,17 @@ class NotOwner(MdvPkgError):
 class TaskBadState(MdvPkgError):
     """Raised if an attempt to call methods on a task is made and its
     state is invalid."""
+
+
+class InvalidAttribute(MdvPkgError):
+    """Raised if a client requests an unknown package attribute."""
+
+
+class InvalidQuery(MdvPkgError):
+    """Raised if a client sends an unknown filter or option, or a
+    value of the wrong type.
+    """
+
+
+class NotAuthorized(MdvPkgError):
+    """Raised if a client calls a method reserved to administrators."""
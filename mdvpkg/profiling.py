@@ -0,0 +1,150 @@
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): J. Victor Martins <jvdm@mandriva.com>
+##
+"""Optional cProfile profiling of daemon work.
+
+Work is profiled on behalf of an owner (e.g. a task, whose co-routine
+steps are profiled separately), and the profile of all its work is
+dumped to the profile directory when the owner finishes, if it took
+at least the threshold time.  Dumps can be read with the pstats
+module.
+
+The profile directory must be owned by the daemon user and writable
+only by it, since dumps have predictable names.
+"""
+
+
+import os
+import stat
+import time
+import marshal
+import itertools
+import logging
+import cProfile
+
+
+## Default directory of profile dumps
+DEFAULT_DIRECTORY = '/var/lib/mdvpkg/profiles'
+## Default minimum profiled time of dumped profiles (seconds)
+DEFAULT_THRESHOLD = 0.0
+
+log = logging.getLogger('mdvpkgd.profiling')
+
+_enabled = False
+_directory = DEFAULT_DIRECTORY
+_threshold = DEFAULT_THRESHOLD
+_profiles = {}  # owner -> [profile, profiled time]
+_active = False
+_serial = itertools.count()
+
+
+def configure(directory=DEFAULT_DIRECTORY, threshold=DEFAULT_THRESHOLD):
+    """Set where profiles are dumped, and the minimum profiled time
+    of dumped profiles.
+    """
+    global _directory, _threshold
+    _directory = directory
+    _threshold = threshold
+
+
+def set_enabled(enabled):
+    """Start or stop profiling.
+
+    Raise EnvironmentError if the profile directory can't be created
+    or isn't safe to write to.
+    """
+    global _enabled
+    if enabled:
+        _check_directory(_directory)
+    _enabled = enabled
+    if not enabled:
+        # started profiles would be incomplete:
+        _profiles.clear()
+    log.info('profiling %s', enabled and 'enabled' or 'disabled')
+
+
+def is_enabled():
+    return _enabled
+
+
+def call(owner, func, *args, **kwargs):
+    """Call func, profiling it when profiling is enabled.
+
+    Profiles are accumulated until finish(owner) is called.
+    """
+    global _active
+    if not _enabled or _active:
+        # already accounted in the active profile:
+        return func(*args, **kwargs)
+    entry = _profiles.get(owner)
+    if entry is None:
+        entry = _profiles[owner] = [cProfile.Profile(), 0.0]
+    _active = True
+    started = time.time()
+    try:
+        return entry[0].runcall(func, *args, **kwargs)
+    finally:
+        entry[1] += time.time() - started
+        _active = False
+
+
+def finish(owner, name):
+    """Dump the profile of an owner's work, if any."""
+    entry = _profiles.pop(owner, None)
+    if entry is not None:
+        _dump(name, entry)
+
+
+def _check_directory(path):
+    """Create the profile directory if needed, raise EnvironmentError
+    if it's not a directory owned by us and only writable by us.
+    """
+    if not os.path.lexists(path):
+        os.makedirs(path, 0700)
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or st.st_mode & 0022):
+        raise EnvironmentError('unsafe profile directory (must be owned '
+                               'and only writable by uid %s): %s'
+                               % (os.getuid(), path))
+
+
+def _dump(name, entry):
+    (profile, elapsed) = entry
+    if elapsed < _threshold:
+        return
+    path = os.path.join(_directory,
+                        '%s-%s-%s.prof' % (name,
+                                           time.strftime('%Y%m%d%H%M%S'),
+                                           _serial.next()))
+    try:
+        # never follow or reuse an existing file:
+        fd = os.open(path,
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                     0600)
+        with os.fdopen(fd, 'wb') as f:
+            # as Profile.dump_stats() does:
+            profile.create_stats()
+            marshal.dump(profile.stats, f)
+    except EnvironmentError as e:
+        log.error('failed to dump profile: %s', e)
+    else:
+        log.info('profile dumped (%.3fs): %s', elapsed, path)
@@ -0,0 +1,123 @@
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): J. Victor Martins <jvdm@mandriva.com>
+##
+"""Management of task results cached for clients."""
+
+
+import collections
+import logging
+import time
+import gobject
+
+
+## Default memory budget for all cached results (bytes)
+DEFAULT_BUDGET = 64 * 1024 * 1024
+## Default time a cached result is kept without being accessed (seconds)
+DEFAULT_EXPIRY = 300
+
+log = logging.getLogger('mdvpkgd.results')
+
+
+class ResultCache(object):
+    """Keep track of tasks holding cached results.
+
+    Results not accessed for `expiry` seconds are expired, and the
+    least recently used results are evicted when the estimated memory
+    of all results is above `budget`.  Tasks must provide
+    `result_size()`, `on_expired()` and `on_evicted()`.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, expiry=DEFAULT_EXPIRY):
+        self.budget = budget
+        self.expiry = expiry
+        # task -> [size, last access time], in LRU order:
+        self._tasks = collections.OrderedDict()
+        self._size = 0
+        self._expire_source = None
+        self.evicted = 0
+        self.expired = 0
+
+    @property
+    def size(self):
+        """Estimated memory held by cached results (bytes)."""
+        return self._size
+
+    def __contains__(self, task):
+        return task in self._tasks
+
+    def add(self, task):
+        """Start managing the results of a task."""
+        size = task.result_size()
+        self._tasks[task] = [size, time.time()]
+        self._size += size
+        log.debug('cached results added: %s, %s bytes', task.path, size)
+        self._enforce_budget()
+        if self._expire_source is None and task in self._tasks:
+            self._expire_source = gobject.timeout_add_seconds(
+                                      max(1, min(self.expiry, 60)),
+                                      self._expire
+                                  )
+
+    def touch(self, task):
+        """Mark a task results as recently used."""
+        entry = self._tasks.pop(task, None)
+        if entry is not None:
+            entry[1] = time.time()
+            self._tasks[task] = entry
+
+    def discard(self, task):
+        """Stop managing a task results, if it was managed."""
+        entry = self._tasks.pop(task, None)
+        if entry is not None:
+            self._size -= entry[0]
+
+    def stats(self):
+        """Return a dict with cached results statistics."""
+        return {'results': len(self._tasks),
+                'size': self._size,
+                'budget': self.budget,
+                'expiry': self.expiry,
+                'evicted': self.evicted,
+                'expired': self.expired}
+
+    def _enforce_budget(self):
+        while self._size > self.budget and self._tasks:
+            task = iter(self._tasks).next()
+            self.discard(task)
+            self.evicted += 1
+            log.info('cached results evicted: %s', task.path)
+            task.on_evicted()
+
+    def _expire(self):
+        """Timeout callback to expire inactive results."""
+        deadline = time.time() - self.expiry
+        for (task, (_, last_access)) in self._tasks.items():
+            if last_access > deadline:
+                # the rest were accessed more recently:
+                break
+            self.discard(task)
+            self.expired += 1
+            log.info('cached results expired: %s', task.path)
+            task.on_expired()
+        if not self._tasks:
+            self._expire_source = None
+            return False
+        return True
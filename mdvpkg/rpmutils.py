@@ -23,5 +23,28 @@
 
 
 import sys
-sys.path.append('%s/%s/mandriva/mdvpkg' % (sys.prefix, sys.lib))
-from _rpmutils import *
+import imp
+
+
+_rpmutils = None
+
+
+def _load():
+    """Import the _rpmutils extension on first use, from the mdvpkg
+    library directory, without adding it to sys.path.
+    """
+    global _rpmutils
+    if _rpmutils is None:
+        lib_dir = '%s/%s/mandriva/mdvpkg' % (sys.prefix, sys.lib)
+        found = imp.find_module('_rpmutils', [lib_dir] + sys.path)
+        try:
+            _rpmutils = imp.load_module('_rpmutils', *found)
+        finally:
+            if found[0] is not None:
+                found[0].close()
+    return _rpmutils
+
+
+def rpmvercmp(a, b):
+    """Compare two version (or release) strings, as rpm does."""
+    return _load().rpmvercmp(a, b)
@@ -0,0 +1,91 @@
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): J. Victor Martins <jvdm@mandriva.com>
+##
+"""Daemon metrics: counters and latency histograms.
+
+Metrics are module level, so any module can update them without
+having the daemon at hand:
+
+>>> mdvpkg.stats.incr('backend.restarts')
+>>> mdvpkg.stats.observe('cache.build_time', 2.5)
+"""
+
+
+import bisect
+import collections
+
+
+## Upper bounds of histogram buckets (seconds)
+BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0)
+
+_counters = collections.defaultdict(int)
+_histograms = {}
+
+
+class Histogram(object):
+    """Distribution of observed values in BUCKETS."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # the last bucket holds values above all bounds:
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value):
+        value = float(value)
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def items(self, name):
+        """Yield (key, value) pairs of the histogram named name, with
+        cumulative bucket counts.
+        """
+        yield ('%s.count' % name, self.count)
+        yield ('%s.sum' % name, self.sum)
+        yield ('%s.max' % name, self.max)
+        cumulative = 0
+        for (bound, count) in zip(BUCKETS, self.buckets):
+            cumulative += count
+            yield ('%s.le.%g' % (name, bound), cumulative)
+
+
+def incr(name, value=1):
+    """Increment a counter."""
+    _counters[name] += value
+
+
+def observe(name, value):
+    """Add a value (e.g. a duration in seconds) to a histogram."""
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = Histogram()
+    histogram.observe(value)
+
+
+def snapshot():
+    """Return a dict with the current value of all metrics."""
+    metrics = dict(_counters)
+    for (name, histogram) in _histograms.iteritems():
+        metrics.update(histogram.items(name))
+    return metrics
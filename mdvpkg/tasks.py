@@ -27,13 +27,24 @@ import logging
 import gobject
 import dbus
 import dbus.service
-import dbus.service
-import uuid
+import dbus.lowlevel
+import collections
 import functools
+import os
+import re
+import struct
+import tempfile
+import sys
+import time
 
 import mdvpkg
 import mdvpkg.worker
 import mdvpkg.exceptions
+import mdvpkg.urpmi.db
+import mdvpkg.urpmi.files
+import mdvpkg.urpmi.text
+import mdvpkg.stats
+import mdvpkg.profiling
 
 
 ## Finish status
@@ -43,6 +54,12 @@ EXIT_CANCELLED = 'exit-cancelled'
 
 ## Error status
 ERROR_TASK_EXCEPTION = 'error-task-exception'
+# Task results were not accessed for too long
+ERROR_INACTIVE = 'error-inactive'
+# Task results were evicted to keep the memory budget
+ERROR_EVICTED = 'error-evicted'
+# A package failed signature or digest verification
+ERROR_VERIFY_FAILED = 'error-verify-failed'
 
 ## Task state
 # The task is being setup
@@ -66,9 +83,124 @@ STATE_DOWNLOADING = 'state-downloading'
 # Task is installing packages
 STATE_INSTALLING = 'state-installing'
 
+## Relative change of the estimated wait of a queued task signaled
+## with Queued() (changes under one second are never signaled)
+QUEUED_WAIT_CHANGE = 0.1
+
+## Task priority classes (lower values are run first)
+# Interactive requests, like listings for user interfaces
+PRIORITY_INTERACTIVE = 0
+# Background requests, like refreshes done by applets
+PRIORITY_BACKGROUND = 1
+# Package installation and removal
+PRIORITY_INSTALL = 2
+
+## Package version attributes clients may request and the D-Bus
+## signature used to marshal their values:
+PACKAGE_ATTRIBUTES = {
+    'name': 's',
+    'version': 's',
+    'release': 's',
+    'arch': 's',
+    'epoch': 'u',
+    'size': 't',
+    'group': 's',
+    'summary': 's',
+    'media': 's',
+    'installtime': 'u',
+    'disttag': 's',
+    'distepoch': 's',
+    'requires': 'aa{ss}',
+    'provides': 'aa{ss}',
+    'conflict': 'aa{ss}',
+    'obsoletes': 'aa{ss}',
+}
+
+## Package filters accepted by QueryPackages(), with the values
+## accepted for each one (None for any string):
+QUERY_FILTERS = {
+    'name': None,
+    'media': None,
+    'group': None,
+    'status': frozenset(('upgrade', 'new', 'installed')),
+}
+## Options accepted by QueryPackages() and their D-Bus signature
+QUERY_OPTIONS = {
+    'cached': 'b',
+}
+_SIGNATURE_TYPES = {'b': (bool, dbus.Boolean)}
+
+## Maximum number of marshalled attribute sets cached in each package
+## version (see version_projection())
+MAX_PROJECTIONS = 4
+
+## Streamed results format identifier and version
+STREAM_MAGIC = 'mdvpkg-stream'
+STREAM_VERSION = '1'
+
 log = logging.getLogger('mdvpkgd.task')
 
 
+def marshalled_size(value):
+    """Estimate the size of a value marshalled in a D-Bus message
+    (without alignment padding), from its D-Bus or Python type.
+    """
+    if isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # length, data and nul byte:
+        return len(value) + 5
+    if isinstance(value, dict):
+        size = 4
+        for (key, item) in value.iteritems():
+            size += marshalled_size(key) + marshalled_size(item)
+        return size
+    if isinstance(value, (list, tuple)):
+        return 4 + sum([ marshalled_size(item) for item in value ])
+    if isinstance(value, dbus.Byte):
+        return 1
+    if isinstance(value, (dbus.Int16, dbus.UInt16)):
+        return 2
+    if isinstance(value, (dbus.Int64, dbus.UInt64, dbus.Double,
+                          long, float)):
+        return 8
+    return 4
+
+
+def task_signal(signature):
+    """Task D-Bus signal decorator.
+
+    Like dbus.service.signal(), but signals are sent only to the task
+    owner (its sender unique name) instead of being broadcast to the
+    whole bus.  The number of signals sent and their estimated size
+    are counted in the signals.<name> and signals.bytes.<name> stats.
+    """
+    def decorator(func):
+        # the dbus signal is only used for its introspection data:
+        dbus_signal = dbus.service.signal(mdvpkg.DBUS_TASK_INTERFACE,
+                                          signature=signature)(func)
+        member = func.__name__
+
+        @functools.wraps(dbus_signal)
+        def emit(self, *args):
+            func(self, *args)
+            mdvpkg.stats.incr('signals.%s' % member)
+            # dbus-python can't tell the size of marshalled messages:
+            mdvpkg.stats.incr('signals.bytes.%s' % member,
+                              sum([ marshalled_size(arg) for arg in args ]))
+            for (connection, path, fallback) in self.locations:
+                message = dbus.lowlevel.SignalMessage(
+                              path,
+                              mdvpkg.DBUS_TASK_INTERFACE,
+                              member
+                          )
+                message.append(signature=signature, *args)
+                message.set_destination(self._sender)
+                connection.send_message(message)
+        return emit
+    return decorator
+
+
 def mdvpkg_coroutine_run(corountine_run):
     """Run method decorator for tasks run methods with co-routine
     implementation (without backend).
@@ -77,7 +209,7 @@ def mdvpkg_coroutine_run(corountine_run):
     def run(self, monitor_gen, urpmi, *args):
         def _coroutine(task_gen):
             try:
-                error = task_gen.next()
+                error = mdvpkg.profiling.call(self, task_gen.next)
             except StopIteration:
                 monitor_gen.close()
             except Exception as e:
@@ -97,32 +229,286 @@ def mdvpkg_coroutine_run(corountine_run):
     return run
 
 
+def check_attributes(attributes):
+    """Check a list of package attributes requested by a client,
+    returning it as a tuple.
+    """
+    for attr in attributes:
+        if attr not in PACKAGE_ATTRIBUTES:
+            log.info('unknown package attribute requested: %s', attr)
+            raise mdvpkg.exceptions.InvalidAttribute(
+                      'unknown package attribute: %s' % attr
+                  )
+    return tuple(attributes)
+
+
+def check_query(filters, options):
+    """Check filters and options of a package query sent by a client.
+
+    Filters are keyed by filter name, or by 'exclude-' and the filter
+    name, with a list of strings as value.  Return a (filters,
+    options) tuple, where filters is a list of (filter_name, exclude,
+    values) tuples.
+    """
+    def invalid(message):
+        log.info('invalid query: %s', message)
+        return mdvpkg.exceptions.InvalidQuery(message)
+
+    checked = []
+    for (key, values) in filters.iteritems():
+        exclude = key.startswith('exclude-')
+        if exclude:
+            name = key[len('exclude-'):]
+        else:
+            name = key
+        if name not in QUERY_FILTERS:
+            raise invalid('unknown filter: %s' % key)
+        if (not isinstance(values, (list, tuple))
+                or not all(isinstance(v, basestring) for v in values)):
+            raise invalid('filter %s needs a list of strings' % key)
+        accepted = QUERY_FILTERS[name]
+        if accepted is not None and not accepted.issuperset(values):
+            raise invalid('filter %s accepts only: %s'
+                          % (key, ', '.join(sorted(accepted))))
+        checked.append((name, exclude, list(values)))
+    for (key, value) in options.iteritems():
+        if key not in QUERY_OPTIONS:
+            raise invalid('unknown option: %s' % key)
+        signature = QUERY_OPTIONS[key]
+        if not isinstance(value, _SIGNATURE_TYPES[signature]):
+            raise invalid('option %s needs a value of type %s'
+                          % (key, signature))
+    return checked, dict(options)
+
+
+def _marshal_string(value):
+    if value is None:
+        value = ''
+    return dbus.String(value)
+
+
+def _marshal_uint32(value):
+    return dbus.UInt32(int(value or 0))
+
+
+def _marshal_uint64(value):
+    return dbus.UInt64(int(value or 0))
+
+
+def _marshal_capabilities(value):
+    caps = dbus.Array(signature='a{ss}')
+    for cap in value or ():
+        caps.append(dbus.Dictionary(
+                        [(k, v or '') for (k, v) in cap.iteritems()],
+                        signature='ss'
+                    ))
+    return caps
+
+
+_MARSHALLERS = {
+    's': _marshal_string,
+    'u': _marshal_uint32,
+    't': _marshal_uint64,
+    'aa{ss}': _marshal_capabilities,
+}
+
+
+def version_projection(attributes):
+    """Return a function mapping a package version to its a{sv}
+    details with the given (already checked) attributes.
+
+    Values are marshalled with explicit D-Bus types so dbus-python
+    doesn't guess them, and the result is cached in the package
+    version, to be reused by later listings of the same attributes (in
+    any order).  At most MAX_PROJECTIONS attribute sets are cached in
+    each version.
+    """
+    key = frozenset(attributes)
+    marshallers = [ (attr, _MARSHALLERS[PACKAGE_ATTRIBUTES[attr]])
+                        for attr in key ]
+
+    def project(rpm):
+        projections = rpm.projections
+        details = projections.get(key)
+        if details is None:
+            details = dbus.Dictionary(
+                          [ (attr, marshal(getattr(rpm, attr)))
+                                for (attr, marshal) in marshallers ],
+                          signature='sv'
+                      )
+            if len(projections) >= MAX_PROJECTIONS:
+                projections.popitem()
+            projections[key] = details
+        return details
+    return project
+
+
+def _stream_value(value):
+    """Text representation of an attribute value in result streams."""
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        # capabilities are written as in synthesis files:
+        caps = []
+        for cap in value:
+            if cap['condition']:
+                caps.append('%s[%s %s]' % (cap['name'],
+                                           cap['condition'],
+                                           cap['version']))
+            else:
+                caps.append(cap['name'])
+        return '@'.join(caps)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _stream_record(fields):
+    """Encode a length-prefixed record of length-prefixed fields."""
+    data = ''.join([ struct.pack('>I', len(field)) + field
+                         for field in fields ])
+    return struct.pack('>I', len(data)) + data
+
+
+class ResultStream(object):
+    """Unlinked temporary file where task results are written to be
+    read by the client through a passed file descriptor.
+
+    The client gets its own read-only file description, so reading
+    doesn't disturb our writing offset, and it's backed by /dev/shm
+    when available.
+    """
+
+    def __init__(self, header):
+        tmp_dir = None
+        if os.path.isdir('/dev/shm'):
+            tmp_dir = '/dev/shm'
+        fd, path = tempfile.mkstemp(prefix='mdvpkg-', dir=tmp_dir)
+        try:
+            self._read_fd = os.open(path, os.O_RDONLY)
+        finally:
+            os.unlink(path)
+        self._file = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.write(header)
+
+    def client_fd(self):
+        """Return the read end as a D-Bus file descriptor."""
+        unix_fd = dbus.types.UnixFd(self._read_fd)
+        os.close(self._read_fd)
+        self._read_fd = None
+        return unix_fd
+
+    def write(self, fields):
+        record = _stream_record(fields)
+        self._file.write(record)
+        self.size += len(record)
+        mdvpkg.stats.incr('stream.bytes', len(record))
+
+    def close(self):
+        if self._read_fd is not None:
+            os.close(self._read_fd)
+            self._read_fd = None
+        if not self._file.closed:
+            self._file.close()
+
+
+class TaskRegistry(object):
+    """Task object paths and sender watches shared by all tasks.
+
+    There's a single name owner watch per sender, which cancels all
+    its tasks when it disconnects, and the paths of removed tasks are
+    reused (oldest first) by new tasks.
+    """
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._watches = {}  # sender -> (watch, set of tasks)
+        self._free_paths = collections.deque()
+        self._next_id = 0
+        self._count = 0
+        # time since there are no tasks:
+        self.idle_since = time.time()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, task, sender):
+        """Register a new task of sender, returning its path."""
+        entry = self._watches.get(sender)
+        if entry is None:
+            watch = self._bus.watch_name_owner(
+                        sender,
+                        functools.partial(self._sender_owner_changed,
+                                          sender)
+                    )
+            entry = self._watches[sender] = (watch, set())
+        entry[1].add(task)
+        self._count += 1
+        if self._free_paths:
+            return self._free_paths.popleft()
+        path = '%s/%s' % (mdvpkg.DBUS_TASK_PATH, self._next_id)
+        self._next_id += 1
+        return path
+
+    def remove(self, task, sender):
+        """Unregister a removed task, releasing its path."""
+        entry = self._watches.get(sender)
+        if entry is None or task not in entry[1]:
+            return
+        (watch, tasks) = entry
+        tasks.remove(task)
+        if not tasks:
+            watch.cancel()
+            del self._watches[sender]
+        self._free_paths.append(task.path)
+        self._count -= 1
+        if not self._count:
+            self.idle_since = time.time()
+
+    def _sender_owner_changed(self, sender, connection):
+        # Since we are watching a unique name this will be only called
+        # when the name is acquired and when the name is released; the
+        # latter will have connection == None:
+        if not connection:
+            entry = self._watches.get(sender)
+            if entry is None:
+                return
+            log.info('task sender disconnected: %s', sender)
+            # mimic the sender cancelling its tasks:
+            for task in list(entry[1]):
+                task.Cancel(sender)
+
+
 class TaskBase(dbus.service.Object):
     """Base class for all tasks."""
 
+    # Read-only tasks only read the package cache (without the
+    # backend) and may run concurrently with other tasks:
+    read_only = False
+    # Priority class of the task in the runner queue:
+    priority = PRIORITY_BACKGROUND
+    # Queued tasks of the same mergeable class may be run in a single
+    # backend call, when the runner merges them (see
+    # mdvpkg.worker.Runner):
+    mergeable = False
+
     def __init__(self, daemon, sender, runner):
         self._bus = daemon.bus
-        self.path = '%s/%s' % (mdvpkg.DBUS_TASK_PATH, uuid.uuid4().get_hex())
-        dbus.service.Object.__init__(
-            self,
-            dbus.service.BusName(mdvpkg.DBUS_SERVICE, self._bus),
-            self.path
-            )
+        self._registry = daemon.tasks
+        self.path = self._registry.add(self, sender)
+        dbus.service.Object.__init__(self, daemon.bus_name, self.path)
 
         self._sender = sender
         self._runner = runner
+        self._queue_position = None
         self.state = STATE_SETTING_UP
         self.canceled = False
 
         # Passed to backend when call_backend is called ...
         self.backend_args = []
         self.backend_kwargs = {}
-
-        # Watch for sender (which is a unique name) changes:
-        self._sender_watch = self._bus.watch_name_owner(
-                                     self._sender,
-                                     self._sender_owner_changed
-                                 )
+        mdvpkg.stats.incr('tasks.created.%s' % self.__class__.__name__)
         log.debug('task created: %s, %s', self._sender, self.path)
 
     @property
@@ -135,6 +521,25 @@ class TaskBase(dbus.service.Object):
         self._state = state
         self.StateChanged(state)
 
+    @property
+    def sender(self):
+        """Unique bus name of the task owner."""
+        return self._sender
+
+    def set_queue_position(self, position, wait):
+        """Set the task position in the runner queue and the estimated
+        wait (seconds) to run, signaling it if the position has changed
+        or the wait changed by more than QUEUED_WAIT_CHANGE.
+        """
+        if self._queue_position is not None:
+            (old_position, old_wait) = self._queue_position
+            tolerance = max(1, old_wait * QUEUED_WAIT_CHANGE)
+            if (position == old_position
+                    and abs(wait - old_wait) <= tolerance):
+                return
+        self._queue_position = (position, wait)
+        self.Queued(position, wait)
+
     #
     # D-Bus methods
     #
@@ -170,14 +575,13 @@ class TaskBase(dbus.service.Object):
     # D-Bus signals
     #
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='s')
+    @task_signal('s')
     def Finished(self, status):
         """Signals that the task has finished successfully."""
         log.debug('Finished(%s): %s', status, self.path)
+        mdvpkg.stats.incr('tasks.finished.%s' % status)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='ss')
+    @task_signal('ss')
     def Error(self, status, message):
         """Signals a task error during running."""
         log.debug('Error(%s, %s): %s',
@@ -185,14 +589,21 @@ class TaskBase(dbus.service.Object):
                   message,
                   self.path)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='s')
+    @task_signal('s')
     def StateChanged(self, state):
         """Signals the task state has changed."""
         log.debug('StateChanged(%s): %s',
                   state,
                   self.path)
 
+    @task_signal('uu')
+    def Queued(self, position, wait):
+        """Signals the task position in queue and estimated wait."""
+        log.debug('Queued(%s, %s): %s',
+                  position,
+                  wait,
+                  self.path)
+
     def run(self, monitor_gen, urpmi, backend):
         """Default runner, must be implemented in childs."""
         raise NotImplementedError()
@@ -226,20 +637,11 @@ class TaskBase(dbus.service.Object):
 
     def _remove_and_cleanup(self):
         """Remove the task from the bus and clean up."""
-        self._sender_watch.cancel()
         self.remove_from_connection()
+        self._registry.remove(self, self._sender)
+        mdvpkg.profiling.finish(self, self.__class__.__name__)
         log.info('task removed: %s', self.path)
 
-    def _sender_owner_changed(self, connection):
-        """Called when the sender owner changes."""
-        # Since we are watching a unique name this will be only called
-        # when the name is acquired and when the name is released; the
-        # latter will have connection == None:
-        if not connection:
-            log.info('task sender disconnected: %s', self.path)
-            # mimic the sender cancelling the task:
-            self.Cancel(self._sender)
-
     def _check_same_user(self, sender):
         """Check if the sender is the task owner created the task."""
         if self._sender != sender:
@@ -257,8 +659,10 @@ class TaskBase(dbus.service.Object):
 class ListMediasTask(TaskBase):
     """List all available medias."""
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='sbb')
+    read_only = True
+    priority = PRIORITY_INTERACTIVE
+
+    @task_signal('sbb')
     def Media(self, media_name, update, ignore):
         log.debug('Media(%s, %s, %s)', media_name, update, ignore)
 
@@ -273,8 +677,10 @@ class ListMediasTask(TaskBase):
 class ListGroupsTask(TaskBase):
     """List all available groups."""
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='su')
+    read_only = True
+    priority = PRIORITY_INTERACTIVE
+
+    @task_signal('su')
     def Group(self, group, count):
         log.debug('Group(%s, %s)', group, count)
 
@@ -286,10 +692,12 @@ class ListGroupsTask(TaskBase):
             yield
 
 
-class ListPackagesTask(TaskBase):
-    """List all available packages."""
+class PackageFilterTask(TaskBase):
+    """Base class for tasks selecting packages through filters."""
 
-    def __init__(self, daemon, sender, runner, attributes):
+    read_only = True
+
+    def __init__(self, daemon, sender, runner):
         TaskBase.__init__(self, daemon, sender, runner)
         self.filters = {'name': {'sets': {},
                                  'match_func': self._match_name},
@@ -299,21 +707,6 @@ class ListPackagesTask(TaskBase):
                                   'match_func': self._match_group},
                         'status': {'sets': {},
                                    'match_func': self._match_status},}
-        # TODO Sanitize attributes by checking PackageCache entry and
-        #      UrpmiPackage attributes.
-        self.attributes = attributes
-        self._create_list = False
-        self._package_list = []
-
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='ussaa{sv}aa{sv}')
-    def Package(self, index, name, status, install_details, upgrade_details):
-        log.debug('Package(%s, %s, %s)', index, name, status)
-
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='u')
-    def Ready(self, list_size):
-        log.debug('Ready(%s)', list_size)
 
     @dbus.service.method(mdvpkg.DBUS_TASK_INTERFACE,
                          in_signature='asb',
@@ -375,6 +768,111 @@ class ListPackagesTask(TaskBase):
         self._check_if_has_run()
         self._append_or_create_filter('status', exclude, {'installed'})
 
+    def set_filters(self, filters):
+        """Set filters from a list of (filter_name, exclude, values)
+        tuples (see check_query()).
+        """
+        for (filter_name, exclude, values) in filters:
+            self._append_or_create_filter(filter_name, exclude, values)
+
+    def _select_entry(self, package):
+        """Apply filters to a package entry and its versions.
+
+        Return the (installs, upgrades) selected versions, or None if
+        the entry was filtered or has no versions selected.
+        """
+        ## Apply filters to package entries ...
+        if self._is_filtered(package.name, 'name') \
+                or self._is_filtered(package.status, 'status'):
+            return None
+
+        ## Apply filters to package version and select only
+        ## entries with versions available ...
+        installs = self._select_versions(package.installs.values())
+        upgrades = self._select_versions(package.upgrades.values())
+        if installs or upgrades:
+            return installs, upgrades
+        return None
+
+    def _select_versions(self, version_list):
+        selected = []
+        for rpm in version_list:
+            if self._is_filtered(rpm.media, 'media') \
+                    or self._is_filtered(rpm.group, 'group'):
+                continue
+            selected.append(rpm)
+        return selected
+
+    #
+    # Filter callbacks and helpers
+    #
+
+    def _append_or_create_filter(self, filter_name, exclude, data):
+        """Append more data to the filter set (selected by exclude
+        flag), or create and initialize the set if it didn't existed.
+        """
+        sets = self.filters[filter_name]['sets']
+        _set = sets.get(exclude)
+        if not _set:
+            _set = set()
+            sets[exclude] = _set
+        _set.update(data)
+
+    def _match_name(self, candidate, patterns):
+        for pattern in patterns:
+            if candidate.find(pattern) != -1:
+                return True
+        return False
+
+    def _match_media(self, media, medias):
+        return media in medias
+
+    def _match_group(self, group, groups):
+        folders = group.split('/')
+        for i in range(1, len(folders) + 1):
+            if '/'.join(folders[:i]) in groups:
+                return True
+        return False
+
+    def _match_status(self, status, statuses):
+        return status in statuses
+
+    def _is_filtered(self, candidate, filter_name):
+        """Check if candidate should be filtered by the rules of filter
+        filter_name.
+        """
+        match_func = self.filters[filter_name]['match_func']
+        for (exclude, data) in self.filters[filter_name]['sets'].items():
+            if exclude ^ (not match_func(candidate, data)):
+                return True
+        return False
+
+
+class ListPackagesTask(PackageFilterTask):
+    """List all available packages."""
+
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, daemon, sender, runner, attributes):
+        # check attributes before the task is put in the bus:
+        self.attributes = check_attributes(attributes)
+        PackageFilterTask.__init__(self, daemon, sender, runner)
+        self._results = daemon.results
+        self._project = version_projection(self.attributes)
+        self._create_list = False
+        self._package_list = []
+        self._stream = None
+        self._count = 0
+
+    @task_signal('ussaa{sv}aa{sv}')
+    def Package(self, index, name, status, install_details, upgrade_details):
+        log.debug('Package(%s, %s, %s)', index, name, status)
+
+    @task_signal('u')
+    def Ready(self, list_size):
+        log.debug('Ready(%s)', list_size)
+        mdvpkg.stats.incr('tasks.cached')
+
     @dbus.service.method(mdvpkg.DBUS_TASK_INTERFACE,
                          in_signature='uas',
                          out_signature='',
@@ -385,10 +883,11 @@ class ListPackagesTask(TaskBase):
         if self.state != STATE_READY:
             log.info('attempt to call Get() without STATE_READY')
             raise mdvpkg.exceptions.TaskBadState
+        self._results.touch(self)
         package, installs, upgrades = self._package_list[index]
         self._emit_package(index,
                            package,
-                           attributes,
+                           version_projection(check_attributes(attributes)),
                            installs,
                            upgrades)
 
@@ -406,9 +905,24 @@ class ListPackagesTask(TaskBase):
         if key in {'status', 'name'}:
             key_func = lambda data: getattr(data[0], key)
         else:
+            check_attributes((key,))
             key_func = lambda data: getattr(data[0].latest, key)
+        self._results.touch(self)
         self._package_list.sort(key=key_func, reverse=reverse)
 
+    @dbus.service.method(mdvpkg.DBUS_TASK_INTERFACE,
+                         in_signature='',
+                         out_signature='',
+                         sender_keyword='sender')
+    def Release(self, sender):
+        """Release cached results and remove the task."""
+        log.debug('Release()')
+        self._check_same_user(sender)
+        if self.state != STATE_READY or not self._create_list:
+            log.info('attempt to call Release() without cached results')
+            raise mdvpkg.exceptions.TaskBadState
+        TaskBase.on_ready(self)
+
     @dbus.service.method(mdvpkg.DBUS_TASK_INTERFACE,
                          in_signature='',
                          out_signature='',
@@ -417,206 +931,468 @@ class ListPackagesTask(TaskBase):
         """Set ListPackage to hold results in cache.
         
         The task will be removed from bus only if sender call
-        Release() or inactive.
+        Release(), or if results are expired or evicted (see
+        mdvpkg.results.ResultCache).
         """
         log.debug('SetCached()')
         self._check_same_user(sender)
         self._check_if_has_run()
+        self.set_cached()
+
+    def set_cached(self):
+        if self._stream is not None:
+            log.info('attempt to call SetCached() on a streamed task')
+            raise mdvpkg.exceptions.TaskBadState
         self._create_list = True
 
+    @dbus.service.method(mdvpkg.DBUS_TASK_INTERFACE,
+                         in_signature='',
+                         out_signature='h',
+                         sender_keyword='sender')
+    def SetStreamed(self, sender):
+        """Write results to a file descriptor instead of emitting
+        Package() signals.
+
+        Return the file descriptor from where the client should read
+        the result records, which are complete after Finished().
+        """
+        log.debug('SetStreamed()')
+        self._check_same_user(sender)
+        self._check_if_has_run()
+        if self._create_list or self._stream is not None:
+            log.info('attempt to call SetStreamed() on a cached or '
+                     'already streamed task')
+            raise mdvpkg.exceptions.TaskBadState
+        self._stream = ResultStream((STREAM_MAGIC, STREAM_VERSION)
+                                        + self.attributes)
+        return self._stream.client_fd()
+
     @mdvpkg_coroutine_run
     def run(self, urpmi):
         self.state = STATE_LISTING
-        count = 0
         for package in urpmi.list_packages():
-            ## Apply filters to package entries ...
-            if self._is_filtered(package.name, 'name') \
-                    or self._is_filtered(package.status, 'status'):
-                continue
-
-            ## Apply filters to package version and select only
-            ## entries with versions available ...
-            installs = self._select_versions(package.installs.values())
-            upgrades = self._select_versions(package.upgrades.values())
-            if installs or upgrades:
-                if self._create_list:
-                    self._package_list.append((package, installs, upgrades))
-                else:
-                    self._emit_package(count,
-                                       package,
-                                       self.attributes,
-                                       installs,
-                                       upgrades)
-                    count += 1
+            self._add_package(package)
             yield
 
     def on_ready(self):
         if self._create_list:
-            self.Ready(len(self._package_list))
+            self._results.add(self)
+            # results may have been evicted right away:
+            if self in self._results:
+                self.Ready(len(self._package_list))
         else:
+            if self._stream is not None:
+                # all records must be written before Finished():
+                self._stream.close()
             TaskBase.on_ready(self)
 
-    def _select_versions(self, version_list):
-        selected = []
-        for rpm in version_list:
-            if self._is_filtered(rpm.media, 'media') \
-                    or self._is_filtered(rpm.group, 'group'):
-                continue
-            selected.append(rpm)
-        return selected
+    def on_expired(self):
+        """Cached results were not accessed for too long."""
+        self.on_error(ERROR_INACTIVE, 'cached results expired')
+
+    def on_evicted(self):
+        """Cached results were evicted to free memory."""
+        self.on_error(ERROR_EVICTED, 'cached results evicted')
+
+    def result_size(self):
+        """Estimate the memory held by cached results (bytes)."""
+        size = sys.getsizeof(self._package_list)
+        for (package, installs, upgrades) in self._package_list:
+            size += sys.getsizeof(installs) + sys.getsizeof(upgrades)
+        # all tuples have the same size:
+        if self._package_list:
+            size += (sys.getsizeof(self._package_list[0])
+                         * len(self._package_list))
+        return size
 
-    def _emit_package(self, count, package, attributes, installs, upgrades):
-        inst_details = dbus.Array()
-        upgr_details = dbus.Array()
-        for rpm in installs:
-            inst_details.append(self._select_version_attrs(rpm, attributes))
-        for rpm in upgrades:
-            upgr_details.append(self._select_version_attrs(rpm, attributes))
+    def _remove_and_cleanup(self):
+        self._results.discard(self)
+        if self._stream is not None:
+            self._stream.close()
+        TaskBase._remove_and_cleanup(self)
+
+    def _add_package(self, package):
+        """Add package to the results if it's selected by filters.
+
+        Return True if the package was added.
+        """
+        selected = self._select_entry(package)
+        if selected is None:
+            return False
+        installs, upgrades = selected
+        if self._create_list:
+            self._package_list.append((package, installs, upgrades))
+        elif self._stream is not None:
+            self._write_package(self._count, package, installs, upgrades)
+            self._count += 1
+        else:
+            self._emit_package(self._count,
+                               package,
+                               self._project,
+                               installs,
+                               upgrades)
+            self._count += 1
+        return True
+
+    def _emit_package(self, count, package, project, installs, upgrades):
         self.Package(count,
                      package.name,
                      package.status,
-                     inst_details,
-                     upgr_details)
-
-    def _select_version_attrs(self, rpm, attributes):
-        details = {}
-        for attr in attributes:
-                value = getattr(rpm, attr)
-                if value == None:
-                    value = ''
-                # bypass type guessing in case of empty lists:
-                if type(value) is list and len(value) == 0:
-                    value = dbus.Array(value, signature='s')
-                details[attr] = value
-        return details
+                     dbus.Array(map(project, installs), signature='a{sv}'),
+                     dbus.Array(map(project, upgrades), signature='a{sv}'))
 
-    #
-    # Filter callbacks and helpers
-    #
+    def _write_package(self, count, package, installs, upgrades):
+        """Write one stream record for each package version."""
+        prefix = (str(count), package.name, package.status)
+        for (kind, versions) in (('install', installs),
+                                 ('upgrade', upgrades)):
+            for rpm in versions:
+                self._stream.write(
+                    prefix + (kind,) + tuple([ _stream_value(getattr(rpm, a))
+                                                   for a in self.attributes ])
+                )
 
-    def _append_or_create_filter(self, filter_name, exclude, data):
-        """Append more data to the filter set (selected by exclude
-        flag), or create and initialize the set if it didn't existed.
-        """
-        sets = self.filters[filter_name]['sets']
-        _set = sets.get(exclude)
-        if not _set:
-            _set = set()
-            sets[exclude] = _set
-        _set.update(data)
 
-    def _match_name(self, candidate, patterns):
-        for pattern in patterns:
-            if candidate.find(pattern) != -1:
-                return True
-        return False
+class ListChangesTask(ListPackagesTask):
+    """List packages changed since a package cache generation."""
 
-    def _match_media(self, media, medias):
-        return media in medias
+    priority = PRIORITY_BACKGROUND
 
-    def _match_group(self, group, groups):
-        folders = group.split('/')
-        for i in range(1, len(folders) + 1):
-            if '/'.join(folders[:i]) in groups:
+    def __init__(self, daemon, sender, runner, generation, attributes):
+        ListPackagesTask.__init__(self, daemon, sender, runner, attributes)
+        self.generation = generation
+
+    @task_signal('ub')
+    def Generation(self, generation, resync):
+        log.debug('Generation(%s, %s)', generation, resync)
+
+    @task_signal('s')
+    def Removed(self, name):
+        log.debug('Removed(%s)', name)
+
+    @mdvpkg_coroutine_run
+    def run(self, urpmi):
+        self.state = STATE_LISTING
+        snapshot = urpmi.snapshot()
+        generation, changes = urpmi.list_changes(self.generation)
+        if changes is None:
+            ## Changes are unknown, client must resync with all
+            ## packages ...
+            self.Generation(generation, True)
+            for package in snapshot.packages.itervalues():
+                self._add_package(package)
+                yield
+        else:
+            self.Generation(generation, False)
+            packages = snapshot.packages
+            for name in changes:
+                package = packages.get(name)
+                if package is None or not self._add_package(package):
+                    self.Removed(name)
+                yield
+
+
+class SearchTextTask(ListPackagesTask):
+    """List packages whose name or summary match words of a query,
+    best matches first (see mdvpkg.urpmi.text).
+    """
+
+    def __init__(self, daemon, sender, runner, query, attributes):
+        # check query before the task is put in the bus:
+        if not mdvpkg.urpmi.text.tokenize(query):
+            log.info('empty text query requested: %s', query)
+            raise mdvpkg.exceptions.InvalidQuery('no words in query')
+        ListPackagesTask.__init__(self, daemon, sender, runner, attributes)
+        self.query = unicode(query)
+
+    @mdvpkg_coroutine_run
+    def run(self, urpmi):
+        self.state = STATE_SEARCHING
+        for step in urpmi.update_text_index():
+            yield
+        packages = urpmi.snapshot().packages
+        for name in urpmi.search_text(self.query):
+            package = packages.get(name)
+            if package is not None:
+                self._add_package(package)
+                yield
+
+
+class AggregatePackagesTask(PackageFilterTask):
+    """Count packages and sum their sizes grouped by a key."""
+
+    def __init__(self, daemon, sender, runner, key):
+        if key not in mdvpkg.urpmi.db.AGGREGATE_KEYS:
+            log.info('unknown aggregation key requested: %s', key)
+            raise mdvpkg.exceptions.InvalidAttribute(
+                      'unknown aggregation key: %s' % key
+                  )
+        PackageFilterTask.__init__(self, daemon, sender, runner)
+        self.key = key
+
+    @task_signal('sutt')
+    def Aggregate(self, value, packages, installed_size, available_size):
+        log.debug('Aggregate(%s, %s, %s, %s)',
+                  value, packages, installed_size, available_size)
+
+    @mdvpkg_coroutine_run
+    def run(self, urpmi):
+        self.state = STATE_LISTING
+        if self._has_filters('name', 'media', 'group'):
+            buckets = {}
+            for package in urpmi.list_packages():
+                self._count_package(buckets, package)
+                yield
+        else:
+            ## Only status filters: use the counters kept by the
+            ## cache ...
+            buckets = {}
+            for ((status, value), counter) \
+                    in urpmi.package_counters(self.key).iteritems():
+                if self._is_filtered(status, 'status'):
+                    continue
+                bucket = buckets.setdefault(value, [0, 0, 0])
+                for i in range(3):
+                    bucket[i] += counter[i]
+        for value in sorted(buckets):
+            self.Aggregate(value, *buckets[value])
+            yield
+
+    def _has_filters(self, *filter_names):
+        for name in filter_names:
+            if self.filters[name]['sets']:
                 return True
         return False
 
-    def _match_status(self, status, statuses):
-        return status in statuses
+    def _count_package(self, buckets, package):
+        selected = self._select_entry(package)
+        if selected is None:
+            return
+        installs, upgrades = selected
+        counters = mdvpkg.urpmi.db.entry_counters(self.key,
+                                                  package.status,
+                                                  installs,
+                                                  upgrades)
+        for (value, counter) in counters.iteritems():
+            bucket = buckets.setdefault(value, [0, 0, 0])
+            for i in range(3):
+                bucket[i] += counter[i]
+
+
+class SearchFilesTask(TaskBase):
+    """Search packages owning files, in the file lists of medias (see
+    mdvpkg.urpmi.files).
+    """
 
-    def _is_filtered(self, candidate, filter_name):
-        """Check if candidate should be filtered by the rules of filter
-        filter_name.
+    read_only = True
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, daemon, sender, runner, patterns):
+        TaskBase.__init__(self, daemon, sender, runner)
+        self._indexes = daemon.files
+        # paths in indexes are utf-8 encoded:
+        self.patterns = [ unicode(pattern).encode('utf-8')
+                              for pattern in patterns ]
+        self.mode = mdvpkg.urpmi.files.SEARCH_EXACT
+
+    @task_signal('ssssas')
+    def PackageFiles(self, name, version, release, arch, files):
+        log.debug('PackageFiles(%s, %s)', name, files)
+
+    @task_signal('ss')
+    def MediaSkipped(self, media_name, reason):
+        log.debug('MediaSkipped(%s, %s)', media_name, reason)
+
+    @dbus.service.method(mdvpkg.DBUS_TASK_INTERFACE,
+                         in_signature='s',
+                         out_signature='',
+                         sender_keyword='sender')
+    def SetMode(self, mode, sender):
+        """Match paths equal to the patterns ('exact', the default),
+        starting with them ('prefix') or matching them as regexes
+        ('regex').
         """
-        match_func = self.filters[filter_name]['match_func']
-        for (exclude, data) in self.filters[filter_name]['sets'].items():
-            if exclude ^ (not match_func(candidate, data)):
-                return True
-        return False
+        log.debug('SetMode(%s)', mode)
+        self._check_same_user(sender)
+        self._check_if_has_run()
+        if mode not in mdvpkg.urpmi.files.SEARCH_MODES:
+            log.info('unknown search mode requested: %s', mode)
+            raise mdvpkg.exceptions.InvalidQuery(
+                      'unknown search mode: %s' % mode
+                  )
+        if mode == mdvpkg.urpmi.files.SEARCH_REGEX:
+            for pattern in self.patterns:
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    raise mdvpkg.exceptions.InvalidQuery(
+                              'bad regex %s: %s' % (pattern, e)
+                          )
+        self.mode = str(mode)
 
+    @mdvpkg_coroutine_run
+    def run(self, urpmi):
+        self.state = STATE_SEARCHING
+        indexes = {}
+        # matching files by (media name, package id):
+        results = {}
+        for media in urpmi.list_medias():
+            if media.ignore:
+                continue
+            for step in self._indexes.update(media):
+                yield
+            index = self._indexes.get(media.name)
+            if index is None:
+                self.MediaSkipped(media.name, self._indexes.error(media.name))
+                continue
+            indexes[media.name] = index
+            for pattern in self.patterns:
+                for matches in index.search(self.mode, pattern):
+                    for (path, package_id) in matches:
+                        results.setdefault((media.name, package_id),
+                                           []).append(path)
+                    yield
+        for (media_name, package_id) in sorted(results):
+            versions = indexes[media_name].package(package_id)
+            files = results[(media_name, package_id)]
+            self.PackageFiles(*versions + (files,))
+            yield
 
-# TODO Fix this. It still using old urpmi backend helper ...
-#
-# class SearchFilesTask(TaskBase):
-#     """Query for package owning file paths."""
-#
-#     def __init__(self, daemon, sender, runner, pattern):
-#         TaskBase.__init__(self, daemon, sender, runner)
-#         self.backend_kwargs['pattern'] = pattern
-#
-#     @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-#                          signature='ssssas')
-#     def PackageFiles(self, name, version, release, arch, files):
-#         log.debug('PackageFiles(%s, %s)', name, files)
-#
-#     @dbus.service.method(mdvpkg.DBUS_TASK_INTERFACE,
-#                          in_signature='b',
-#                          out_signature='',
-#                          sender_keyword='sender')
-#     def SetRegex(self, regex, sender):
-#         self._check_same_user(sender)
-#         log.debug('SetRegex()')
-#         """Match file names using a regex."""
-#         self.args.append('fuzzy')
-#
-#     def run(self):
-#         for r in self._backend_helper(backend, 'search_files'):
-#             self.PackageFiles(r['name'], r['version'], r['release'],
-#                                   r['arch'], r['files'])
-#             yield
 
 class InstallPackagesTask(TaskBase):
     """Install packages or upgrades by name."""
 
+    priority = PRIORITY_INSTALL
+    mergeable = True
+
     def __init__(self, daemon, sender, runner, names):
         TaskBase.__init__(self, daemon, sender, runner)
         self.names = names
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='s')
+    @task_signal('s')
     def PreparingStart(self, total):
         log.debug('PreparingStart(%s)', total)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='ss')
+    @task_signal('ss')
     def Preparing(self, amount, total):
         log.debug('Preparing(%s, %s)', amount, total)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='')
+    @task_signal('')
     def PreparingDone(self):
         log.debug('PreparingDone()')
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='s')
+    @task_signal('s')
     def DownloadStart(self, name):
         log.debug('DownloadStart(%s)', name)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='sssss')
+    @task_signal('sssss')
     def Download(self, name, percent, total, eta, speed):
         log.debug('Download(%s, %s, %s, %s, %s)',
                   name, percent, total, eta, speed)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='s')
+    @task_signal('s')
     def DownloadDone(self, name):
         log.debug('DownloadDone(%s)', name)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='ss')
+    @task_signal('ss')
     def DownloadError(self, name, message):
         log.debug('DownloadError(%s, %s)', name, message)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='ss')
+    @task_signal('ss')
+    def VerifyError(self, name, message):
+        log.debug('VerifyError(%s, %s)', name, message)
+
+    @task_signal('ss')
     def InstallStart(self, name, total):
         log.debug('InstallStart(%s, %s)', name, total)
 
-    @dbus.service.signal(dbus_interface=mdvpkg.DBUS_TASK_INTERFACE,
-                         signature='sss')
+    @task_signal('sss')
     def Install(self, name, amount, total):
         log.debug('Install(%s, %s, %s)', name, amount, total)
 
     def run(self, monitor_gen, urpmi, backend):
-        backend.install_packages(monitor_gen, self, self.names)
+        self._install(monitor_gen, self, self.names, backend, self._runner)
+
+    @classmethod
+    def run_merged(cls, monitor_gen, router, urpmi, backend):
+        """Install packages of several tasks in a single transaction.
+
+        `monitor_gen` must forward the transaction outcome to all
+        tasks, and `router` (a SignalRouter) their signals.
+        """
+        names = []
+        for task in router.tasks:
+            names.extend(name for name in task.names if name not in names)
+        cls._install(monitor_gen,
+                     router,
+                     names,
+                     backend,
+                     router.tasks[0]._runner)
+
+    @staticmethod
+    def _install(monitor_gen, target, names, backend, runner):
+        if runner.downloader is None:
+            backend.install_packages(monitor_gen, target, names)
+        else:
+            mdvpkg.worker.InstallPipeline(monitor_gen,
+                                          target,
+                                          names,
+                                          backend,
+                                          runner.downloader,
+                                          runner.verifier).start()
+
+
+class ResolvePackagesTask(TaskBase):
+    """Resolve the dependencies of installing packages by name,
+    without installing them.
+    """
+
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, daemon, sender, runner, names):
+        TaskBase.__init__(self, daemon, sender, runner)
+        self.names = names
+        self._resolution_key = None
+
+    @task_signal('a(sssstt)astt')
+    def Resolved(self, install, remove, download_size, installed_size):
+        log.debug('Resolved(%s, %s, %s, %s)',
+                  len(install), len(remove), download_size, installed_size)
+
+    def run(self, monitor_gen, urpmi, backend):
+        # update an outdated cache first, and catch rpmdb changes not
+        # seen by the cache yet:
+        self._resolution_key = (urpmi.snapshot().generation,
+                                urpmi.fingerprint())
+        resolution = self._runner.resolutions.get(self.names,
+                                                  self._resolution_key)
+        if resolution is not None:
+            log.debug('using cached resolution: %s', self.names)
+            self._emit_resolved(*resolution)
+            monitor_gen.close()
+        else:
+            self.state = STATE_SOLVING
+            backend.resolve_packages(monitor_gen, self, self.names)
+
+    def on_result(self, install, remove):
+        """Backend has resolved dependencies."""
+        install = tuple( (pkg['name'],
+                          pkg['version'],
+                          pkg['release'],
+                          pkg['arch'],
+                          pkg['filesize'],
+                          pkg['size'])
+                             for pkg in install )
+        remove = tuple(remove)
+        self._runner.resolutions.put(self.names,
+                                     self._resolution_key,
+                                     (install, remove))
+        self._emit_resolved(install, remove)
+
+    def _emit_resolved(self, install, remove):
+        self.Resolved(
+            dbus.Array(install, signature='(sssstt)'),
+            dbus.Array(remove, signature='s'),
+            dbus.UInt64(sum(pkg[4] for pkg in install)),
+            dbus.UInt64(sum(pkg[5] for pkg in install))
+        )
@@ -23,14 +23,22 @@
 """UrpmiDB classes."""
 
 
+import os
 import os.path
 import subprocess
 import re
+import time
+import collections
+import cPickle
 import pyinotify
 import gobject
 import logging
 import rpm
 
+import mdvpkg
+import mdvpkg.stats
+import mdvpkg.profiling
+import mdvpkg.urpmi.text
 from mdvpkg.urpmi.media import UrpmiMedia
 
 
@@ -42,9 +50,54 @@ STATE_OUTDATED = 'state-outdated'
 # Cache is broken (configuration file is missing or broken):
 STATE_MISSING_CONFIG = 'state-missing-config'
 
+## Package entry changes recorded in the cache changelog:
+CHANGE_ADDED = 'added'
+CHANGE_REMOVED = 'removed'
+CHANGE_STATUS = 'status'
+CHANGE_VERSIONS = 'versions'
+
+## Maximum number of entry changes kept in the cache changelog:
+CHANGELOG_SIZE = 10000
+
+## Keys package counters are grouped by:
+AGGREGATE_KEYS = ('status', 'group', 'media', 'arch')
+
+## Number of cache update traces kept:
+TRACE_SIZE = 20
+
+## Package cache snapshots saved on exit and restored on startup:
+DEFAULT_SNAPSHOT_PATH = mdvpkg.DEFAULT_SNAPSHOT_PATH
+SNAPSHOT_VERSION = 1
+# rpmdb files changed by transactions (but not by queries), for the
+# Berkeley DB, sqlite and ndb backends:
+RPMDB_FILES = ('Packages', 'rpmdb.sqlite', 'rpmdb.sqlite-wal',
+               'Packages.db')
+
 log = logging.getLogger('mdvpkgd.urpmi')
 
 
+def entry_counters(key, status, installs, upgrades):
+    """Return the counters of a package entry with the given status
+    and installs and upgrades versions, for an aggregation key.
+
+    Counters are keyed by the value of key (the status or a version
+    attribute) and are lists with the number of packages (1), the size
+    of installed versions and the size of available versions.
+    """
+    counters = {}
+    for (i, versions) in ((1, installs), (2, upgrades)):
+        for pkg in versions:
+            if key == 'status':
+                value = status
+            else:
+                value = getattr(pkg, key)
+            counter = counters.get(value)
+            if counter is None:
+                counter = counters[value] = [1, 0, 0]
+            counter[i] += pkg.size
+    return counters
+
+
 class UrpmiDB(gobject.GObject):
     """Provide access to the urpmi database of medias and packages."""
 
@@ -55,26 +108,52 @@ class UrpmiDB(gobject.GObject):
         'cache-outdated': ( gobject.SIGNAL_RUN_FIRST,
                             gobject.TYPE_NONE,
                             () ),
+        'media-changed': ( gobject.SIGNAL_RUN_FIRST,
+                           gobject.TYPE_NONE,
+                           () ),
     }
 
     def __init__(self, 
                  conf_dir='/etc/urpmi',
                  data_dir='/var/lib/urpmi',
                  conf_file='urpmi.cfg',
-                 rpmdb_path=None):
+                 rpmdb_path=None,
+                 snapshot_path=None):
         gobject.GObject.__init__(self)
         self._conf_dir = os.path.abspath(conf_dir)
         self._data_dir = os.path.abspath(data_dir)
         self._conf_path = '%s/%s' % (self._conf_dir, conf_file)
+        self._rpmdb_path = rpmdb_path
         if rpmdb_path is None:
             self.rpmdb_option = ''
         else:
             self.rpmdb_option = '--dbpath %s' % rpmdb_path
+        # snapshot to restore the cache from, instead of loading it,
+        # if it's still valid:
+        self._restore_path = snapshot_path
 
         ## Cache data and state ...
         self._cache_state = STATE_OUTDATED
         self._cache = {}  # package cache with data read from medias
+        self._snapshot = None  # snapshot of the current cache data
         self._groups = {}  # list of package groups found in cache
+        self._counters = {}  # package counters by aggregation key
+        # text index of names and summaries, built on first search:
+        self._text_index = None
+        self._text_building = False
+
+        ## Cache generation and changelog ...
+
+        # Start generations from current time, so that generations
+        # known by clients from a previous daemon instance are not
+        # taken as valid:
+        self.generation = int(time.time())
+        # list of (generation, name, changes) for each changed entry:
+        self._changelog = collections.deque()
+        # oldest generation since which all changes are known:
+        self._changelog_start = self.generation
+        # traces of the last cache updates:
+        self.traces = collections.deque(maxlen=TRACE_SIZE)
 
         ## Set up inotify for changes in configuration file, use
         ## gobject.io_add_watch() for new inotify events ...
@@ -138,43 +217,275 @@ class UrpmiDB(gobject.GObject):
                                  data_dir=self._data_dir,
                                  key=key)
 
+    def snapshot(self):
+        """Return a snapshot of the package cache.
+
+        Populate the package cache first if it's outdated.  The same
+        snapshot is shared until the cache is updated.
+        """
+        self._check_cache_state()
+        if self._snapshot is None:
+            self._snapshot = CacheSnapshot(self.generation,
+                                           self._cache,
+                                           self._groups)
+        return self._snapshot
+
     def list_packages(self):
         """Iteration over all packages entries in the database.
         
         Populate the package cache first if it's outdated.
         """
         log.info('listing packages.')
-        self._check_cache_state()
-        return self._cache.itervalues()
+        return self.snapshot().packages.itervalues()
 
     def list_groups(self):
         """Iteration over all package groups in the database."""
         log.info('listing groups.')
+        return self.snapshot().groups.iteritems()
+
+    def list_changes(self, generation):
+        """Return the package entries changed since a cache
+        generation.
+
+        Return a (current_generation, changes) tuple, where changes is
+        a dict mapping package names to the set of changes done to
+        their entries.  changes is None if the changes since
+        generation are not known (e.g. the changelog was truncated or
+        generation is from another daemon instance).
+        """
         self._check_cache_state()
-        return self._groups.iteritems()
+        if not self._changelog_start <= generation <= self.generation:
+            return self.generation, None
+        changes = {}
+        for (change_gen, name, entry_changes) in reversed(self._changelog):
+            if change_gen <= generation:
+                break
+            changes.setdefault(name, set()).update(entry_changes)
+        return self.generation, changes
+
+    def update_text_index(self):
+        """Build the text index of package names and summaries, if it
+        wasn't built yet.  Once built, it's updated with the package
+        cache.
+
+        This is a co-routine, yielding while the index is built (see
+        mdvpkg.urpmi.text.TextIndex.build()).
+        """
+        while self._text_building:
+            # another task is building it:
+            yield
+        if self._text_index is not None:
+            return
+        self._text_building = True
+        try:
+            started = time.time()
+            while True:
+                ## Index a snapshot, then the entries changed while
+                ## indexing it ...
+                snapshot = self.snapshot()
+                index = mdvpkg.urpmi.text.TextIndex()
+                for step in index.build(snapshot.packages.itervalues()):
+                    yield
+                (_, changes) = self.list_changes(snapshot.generation)
+                if changes is not None:
+                    break
+                log.debug('package cache changed, indexing it again.')
+            for name in changes:
+                index.update(name, self._cache.get(name))
+            self._text_index = index
+            log.info('text index built (%.3fs).', time.time() - started)
+        finally:
+            self._text_building = False
+
+    def search_text(self, query):
+        """Return the names of the packages whose name or summary
+        match words of query, best matches first (see
+        mdvpkg.urpmi.text.TextIndex).
+
+        The index must have been built with update_text_index().
+        """
+        self._check_cache_state()
+        if self._text_index is None:
+            raise ValueError('text index not built')
+        return self._text_index.search(query)
+
+    def package_counters(self, key):
+        """Return package counters for an aggregation key.
+
+        Counters are kept in a dict keyed by (status, value) tuples,
+        where value is the package status or the version attribute
+        named by key.  Each counter is a list with the number of
+        packages, the size of installed versions and the size of
+        available (upgrade or new) versions.
+        """
+        self._check_cache_state()
+        return self._counters[key]
+
+    def fingerprint(self):
+        """Return the modification times and sizes of the files the
+        package cache is loaded from: urpmi configuration, synthesis
+        of non-ignored medias and rpmdb.
+        """
+        def stat(path):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            return (st.st_mtime, st.st_size)
+
+        rpmdb_path = self._rpmdb_path
+        if rpmdb_path is None:
+            rpmdb_path = rpm.expandMacro('%{_dbpath}')
+        return (stat(self._conf_path),
+                tuple([ (media.name, stat(media.hdlist_path))
+                            for media in self.list_medias()
+                            if not media.ignore ]),
+                tuple([ (name, stat(os.path.join(rpmdb_path, name)))
+                            for name in RPMDB_FILES ]))
+
+    def save_snapshot(self, path):
+        """Save the package cache to path, if it's updated, to be
+        restored by another daemon instance (see restore_snapshot()).
+        """
+        if self.cache_state != STATE_UPDATED:
+            log.debug('cache not loaded, snapshot not saved.')
+            return False
+        started = time.time()
+        data = {'version': SNAPSHOT_VERSION,
+                'fingerprint': self.fingerprint(),
+                'generation': self.generation,
+                'packages': [ (entry.name,
+                               entry.installs,
+                               entry.upgrades,
+                               entry.downgrades)
+                                  for entry in self._cache.itervalues() ],
+                'groups': self._groups,
+                'counters': self._counters}
+        directory = os.path.dirname(path)
+        tmp_path = '%s.%s' % (path, os.getpid())
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0755)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0644)
+            with os.fdopen(fd, 'wb') as output:
+                cPickle.dump(data, output, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except EnvironmentError as e:
+            log.error('failed to save cache snapshot: %s', e)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return False
+        log.info('cache snapshot saved (%.3fs): %s',
+                 time.time() - started,
+                 path)
+        return True
+
+    def restore_snapshot(self, path):
+        """Restore the package cache from a snapshot saved by
+        save_snapshot(), if the files the cache is loaded from haven't
+        changed since then.
+
+        The cache generation is restored too, so clients keep their
+        generations of the cache.
+        """
+        trace = CacheTrace()
+        started = time.time()
+        try:
+            st = os.stat(path)
+            # the snapshot is unpickled, only trust our own files:
+            if st.st_uid != os.getuid() or st.st_mode & 0022:
+                log.warning('ignoring cache snapshot with unsafe '
+                            'permissions: %s', path)
+                return False
+            with open(path, 'rb') as snapshot_file:
+                data = cPickle.load(snapshot_file)
+        except EnvironmentError as e:
+            if os.path.exists(path):
+                log.warning('failed to read cache snapshot: %s', e)
+            return False
+        except Exception as e:
+            log.warning('broken cache snapshot: %s', e)
+            return False
+        if data.get('version') != SNAPSHOT_VERSION:
+            log.info('cache snapshot version changed, not restored.')
+            return False
+        if data['fingerprint'] != self.fingerprint():
+            log.info('cache snapshot is outdated, not restored.')
+            return False
+        trace.add_phase('snapshot', time.time() - started,
+                        len(data['packages']))
+
+        started = time.time()
+        self._cache = {}
+        for (name, installs, upgrades, downgrades) in data['packages']:
+            entry = PackageCacheEntry(name)
+            entry.installs = installs
+            entry.upgrades = upgrades
+            entry.downgrades = downgrades
+            self._cache[name] = entry
+        self._groups = data['groups']
+        self._counters = data['counters']
+        self._snapshot = None
+        self._text_index = None
+        self.generation = data['generation']
+        self._changelog.clear()
+        self._changelog_start = self.generation
+        trace.add_phase('entries', time.time() - started, len(self._cache))
+
+        self.cache_state = STATE_UPDATED
+        trace.finish(self.generation)
+        self.traces.append(trace)
+        mdvpkg.stats.incr('cache.restores')
+        log.info('package cache restored from snapshot (%.3fs).',
+                 trace.duration)
+        return True
 
     def _check_cache_state(self):
         if self.cache_state == STATE_OUTDATED:
+            if self._restore_path is not None:
+                # only restore the cache of a previous instance:
+                path, self._restore_path = self._restore_path, None
+                if not self._cache and self.restore_snapshot(path):
+                    return
             log.debug('cache is outdated, updating cache.')
-            self._update_cache()
+            # profiled by itself, unless a task step is being profiled:
+            try:
+                mdvpkg.profiling.call(self, self._update_cache)
+            finally:
+                mdvpkg.profiling.finish(self, 'update_cache')
         elif self.cache_state == STATE_MISSING_CONFIG:
             # FIXME Is this the best way to handle it?
             raise Exception, 'urpmi configuration was deleted'
 
     def _update_cache(self):
         """Loads package data from urpmi database to the package cache."""
+        trace = CacheTrace()
         # forget previous data:
         self.cache_state = STATE_OUTDATED
         old_cache, self._cache = self._cache, {}
         self._groups = {}
+        self._snapshot = None
 
-        self._load_installed_packages()
-        self._load_nonignored_media_packages()
+        started = time.time()
+        medias = [ m for m in self.list_medias() if not m.ignore ]
+        trace.add_phase('config', time.time() - started, len(medias))
+        self._load_installed_packages(trace)
+        self._load_nonignored_media_packages(medias, trace)
+        trace.add_phase('merge', trace.merge_time, trace.packages)
 
         ## Compare new packages in the cache with the old ones ...
+        started = time.time()
+        first_load = not old_cache
+        changelog = []
+        # previous versions of removed and changed entries:
+        stale = []
+        # (object, signal, args) to emit when the cache is updated:
+        emissions = []
         for name in self._cache.iterkeys():
             if name not in old_cache:
-                self.emit('new-package', name)
+                changelog.append((name, (CHANGE_ADDED,)))
+                emissions.append((self, 'new-package', (name,)))
         while True:
             try:
                 name, old_entry = old_cache.popitem()
@@ -183,18 +494,109 @@ class UrpmiDB(gobject.GObject):
             else:
                 new_entry = self._cache.pop(name, None)
                 if new_entry is None:
-                    old_entry.emit('deleted')
+                    changelog.append((name, (CHANGE_REMOVED,)))
+                    emissions.append((old_entry, 'deleted', ()))
+                    stale.append(old_entry)
                 else:
+                    changes = old_entry.compare(new_entry)
+                    if changes:
+                        # versions are replaced by update():
+                        stale.append(PackageSnapshot(old_entry))
                     old_entry.update(new_entry)
                     self._cache[name] = old_entry
-                    old_entry.emit('updated')
+                    if changes:
+                        changelog.append((name, changes))
+                        emissions.append((old_entry, 'updated', ()))
+        self._log_changes(changelog, first_load)
+        trace.add_phase('diff', time.time() - started, len(changelog))
+
+        started = time.time()
+        for (obj, signal, args) in emissions:
+            obj.emit(signal, *args)
+        trace.add_phase('signals', time.time() - started, len(emissions))
+
+        started = time.time()
+        if first_load or not self._counters:
+            self._count_packages()
+            trace.add_phase('counters', time.time() - started,
+                            len(self._cache))
+        else:
+            ## Only count again changed entries ...
+            for entry in stale:
+                self._count_entry(entry, -1)
+            for (name, changes) in changelog:
+                entry = self._cache.get(name)
+                if entry is not None:
+                    self._count_entry(entry, 1)
+            trace.add_phase('counters', time.time() - started,
+                            len(changelog))
+
+        if self._text_index is not None:
+            started = time.time()
+            count = 0
+            for (name, changes) in changelog:
+                if changes != (CHANGE_STATUS,):
+                    self._text_index.update(name, self._cache.get(name))
+                    count += 1
+            trace.add_phase('text', time.time() - started, count)
 
         self.cache_state = STATE_UPDATED
+        trace.finish(self.generation)
+        self.traces.append(trace)
+        mdvpkg.stats.incr('cache.builds')
+        mdvpkg.stats.incr('cache.changes', len(changelog))
+        mdvpkg.stats.observe('cache.build_time', trace.duration)
         log.info('package cache updated.')
 
-    def _load_installed_packages(self):
+    def _log_changes(self, changelog, first_load):
+        """Start a new cache generation if there are changes, adding
+        them to the changelog.
+        """
+        if not changelog:
+            return
+        self.generation += 1
+        if first_load:
+            # every entry was added, don't flood the changelog:
+            self._changelog_start = self.generation
+            return
+        for (name, changes) in changelog:
+            self._changelog.append((self.generation, name, changes))
+        while len(self._changelog) > CHANGELOG_SIZE:
+            self._changelog_start = self._changelog.popleft()[0]
+        log.debug('cache generation %s: %s entries changed',
+                  self.generation,
+                  len(changelog))
+
+    def _count_packages(self):
+        """Count all packages of the package cache again."""
+        self._counters = dict([ (key, {}) for key in AGGREGATE_KEYS ])
+        for entry in self._cache.itervalues():
+            self._count_entry(entry, 1)
+
+    def _count_entry(self, entry, sign):
+        """Add (sign 1) or subtract (sign -1) an entry to package
+        counters.
+        """
+        status = entry.status
+        for key in AGGREGATE_KEYS:
+            counters = self._counters[key]
+            changes = entry_counters(key,
+                                     status,
+                                     entry.installs.itervalues(),
+                                     entry.upgrades.itervalues())
+            for (value, entry_counter) in changes.iteritems():
+                counter = counters.setdefault((status, value), [0, 0, 0])
+                for i in range(3):
+                    counter[i] += sign * entry_counter[i]
+                if not counter[0]:
+                    del counters[(status, value)]
+
+    def _load_installed_packages(self, trace):
         """Visit rpmdb and load data from installed packages."""
         log.info('reading installed packages.')
+        started = time.time()
+        merge_time = trace.merge_time
+        count = 0
         urpmipkg_data = {}
         for pkg in rpm.ts().dbMatch():
             for attr in ('name', 'version', 'release', 'arch', 'epoch',
@@ -211,15 +613,28 @@ class UrpmiDB(gobject.GObject):
             # TODO Load capabilities information in the same manner
             #      Media.list_medias() will return.
 
-            self._on_package_data(urpmipkg_data)
+            trace.merge(self._on_package_data, urpmipkg_data)
+            count += 1
+        merge_time = trace.merge_time - merge_time
+        trace.add_phase('rpmdb', time.time() - started - merge_time, count)
 
-    def _load_nonignored_media_packages(self):
+    def _load_nonignored_media_packages(self, medias, trace):
         """Load packages from non-ignored medias."""
         log.info('reading packages from medias.')
-        for media in [ m for m in self.list_medias() if not m.ignore ]:
+        for media in medias:
+            started = time.time()
+            merge_time = trace.merge_time
+            count = 0
             for package_data in media.list():
                 package_data['media'] = media.name
-                self._on_package_data(package_data)
+                trace.merge(self._on_package_data, package_data)
+                count += 1
+            # decompressing and parsing the synthesis:
+            merge_time = trace.merge_time - merge_time
+            trace.add_phase('media',
+                            time.time() - started - merge_time,
+                            count,
+                            media.name)
 
     def _on_package_data(self, package_data):
         """Handle package data found during cache update.
@@ -284,6 +699,7 @@ class UrpmiDB(gobject.GObject):
             if event.mask & (pyinotify.IN_MODIFY):
                 log.info('urpmi configuration has changed.')
                 self.cache_state = STATE_OUTDATED
+                self.emit('media-changed')
             elif event.mask & (pyinotify.IN_DELETE
                                    | pyinotify.IN_DELETE_SELF
                                    | pyinotify.IN_MOVE_SELF):
@@ -301,43 +717,25 @@ class UrpmiDB(gobject.GObject):
         return True
         
 
-class PackageCacheEntry(gobject.GObject):
-    """Represent a package in the urpmi database cache."""
-
-    __gsignals__ = {
-        'deleted': (
-            gobject.SIGNAL_RUN_FIRST,
-            gobject.TYPE_NONE,
-            ()
-        ),
-        'updated': (
-            gobject.SIGNAL_RUN_FIRST,
-            gobject.TYPE_NONE,
-            ()
-        ),
-    }
+class PackageVersions(object):
+    """Package versions of a package name, grouped by installs,
+    upgrades and downgrades dicts keyed by version-release.
+    """
 
-    def __init__(self, name):
-        gobject.GObject.__init__(self)
-        self.name = name
-        self.installs = {}
-        self.upgrades = {}
-        self.downgrades = {}
+    __slots__ = ()
 
-    def update(self, other_entry):
-        """Update us to reflect package information from another
-        entry.
-
-        After this the two entries will essencially provide the same
-        package information.
+    def compare(self, other_entry):
+        """Return a tuple with the changes (CHANGE_STATUS and/or
+        CHANGE_VERSIONS) from us to another entry of the same package.
         """
-        if self.name != other_entry.name:
-            raise ValueError, ( 'updating entries for different '
-                                'packages: %s, %s'
-                                % (self.name, other_entry.name) )
-        self.installs = other_entry.installs
-        self.upgrades = other_entry.upgrades
-        self.downgrades = other_entry.downgrades
+        changes = ()
+        if self.status != other_entry.status:
+            changes += (CHANGE_STATUS,)
+        for attr in ('installs', 'upgrades', 'downgrades'):
+            if set(getattr(self, attr)) != set(getattr(other_entry, attr)):
+                changes += (CHANGE_VERSIONS,)
+                break
+        return changes
 
     @property
     def status(self):
@@ -381,6 +779,105 @@ class PackageCacheEntry(gobject.GObject):
                               self.name,
                               id(self))
 
+
+class PackageCacheEntry(gobject.GObject, PackageVersions):
+    """Represent a package in the urpmi database cache."""
+
+    __gsignals__ = {
+        'deleted': (
+            gobject.SIGNAL_RUN_FIRST,
+            gobject.TYPE_NONE,
+            ()
+        ),
+        'updated': (
+            gobject.SIGNAL_RUN_FIRST,
+            gobject.TYPE_NONE,
+            ()
+        ),
+    }
+
+    def __init__(self, name):
+        gobject.GObject.__init__(self)
+        self.name = name
+        self.installs = {}
+        self.upgrades = {}
+        self.downgrades = {}
+
+    def update(self, other_entry):
+        """Update us to reflect package information from another
+        entry.
+
+        After this the two entries will essencially provide the same
+        package information.
+        """
+        if self.name != other_entry.name:
+            raise ValueError, ( 'updating entries for different '
+                                'packages: %s, %s'
+                                % (self.name, other_entry.name) )
+        # version dicts are replaced, never changed, so snapshots
+        # keep seeing the previous versions:
+        self.installs = other_entry.installs
+        self.upgrades = other_entry.upgrades
+        self.downgrades = other_entry.downgrades
+
+
+class PackageSnapshot(PackageVersions):
+    """Versions of a package cache entry at a cache generation."""
+
+    __slots__ = ('name', 'installs', 'upgrades', 'downgrades')
+
+    def __init__(self, entry):
+        self.name = entry.name
+        self.installs = entry.installs
+        self.upgrades = entry.upgrades
+        self.downgrades = entry.downgrades
+
+
+class CacheTrace(object):
+    """Durations and item counts of the phases of a cache update."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.duration = 0.0
+        self.generation = 0
+        self.phases = []
+        # time spent adding package data to the cache, which is
+        # interleaved with reading it:
+        self.merge_time = 0.0
+        self.packages = 0
+
+    def add_phase(self, name, duration, items, media=''):
+        self.phases.append({'phase': name,
+                            'media': media,
+                            'duration': duration,
+                            'items': items})
+
+    def merge(self, handler, package_data):
+        """Call the handler adding package data to the cache."""
+        started = time.time()
+        handler(package_data)
+        self.merge_time += time.time() - started
+        self.packages += 1
+
+    def finish(self, generation):
+        self.duration = time.time() - self.started
+        self.generation = generation
+
+
+class CacheSnapshot(object):
+    """Consistent view of the package cache at a generation.
+
+    Tasks reading the cache should hold a snapshot while running, so
+    cache updates don't change the data they're listing.
+    """
+
+    def __init__(self, generation, cache, groups):
+        self.generation = generation
+        self.packages = dict([ (name, PackageSnapshot(entry))
+                                   for (name, entry) in cache.iteritems() ])
+        self.groups = dict(groups)
+
+
 class UrpmiPackage(object):
     """A package in the rpm/urpmi database."""
 
@@ -403,6 +900,15 @@ class UrpmiPackage(object):
         self.provides = data.get('provides', [])
         self.conflict = data.get('conflict', [])
         self.obsoletes = data.get('obsoletes', [])
+        # D-Bus marshalled attributes, keyed by attribute set (see
+        # mdvpkg.tasks.version_projection()):
+        self.projections = {}
+
+    def __getstate__(self):
+        # projections are not pickled in cache snapshots:
+        state = self.__dict__.copy()
+        state['projections'] = {}
+        return state
 
     @property
     def installed(self):
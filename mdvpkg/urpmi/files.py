@@ -0,0 +1,481 @@
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): J. Victor Martins <jvdm@mandriva.com>
+##
+"""File path indexes of urpmi medias, for file searches.
+
+The file lists of the packages of a media are read from its
+files.xml.lzma xml-info file and kept in an index file, which is
+rebuilt only when the xml-info or synthesis files change.  Index
+files are read through mmap and have:
+
+    header
+    block offsets     (uint32 each)
+    package offsets   (uint32 each)
+    packages          (uint16 length, 'name\\0version\\0release\\0arch')
+    entries           (uint16 shared prefix length, uint16 suffix
+                       length, uint32 package id, path suffix)
+
+Entries are sorted by path and each path is stored as the length of
+the prefix it shares with the previous path and the rest of it.  The
+first entry of each block of BLOCK_SIZE entries shares no prefix, so
+paths are looked up with a binary search on blocks.
+
+Indexes are built with an external merge sort, so at most RUN_SIZE
+paths are kept in memory, and from co-routines yielding to the main
+loop every STEP paths.
+"""
+
+
+import os
+import re
+import mmap
+import heapq
+import struct
+import logging
+import tempfile
+import subprocess
+import xml.sax.saxutils
+
+import mdvpkg
+
+
+## Default directory of index files
+DEFAULT_DIRECTORY = mdvpkg.DEFAULT_FILE_INDEX_DIR
+## Index file format identifier and version
+INDEX_MAGIC = 'MDVPKGFI'
+INDEX_VERSION = 1
+## Number of entries in each block of an index
+BLOCK_SIZE = 16
+## Number of xml-info lines read, or index entries written or
+## searched, between yields of co-routines
+STEP = 5000
+## Number of entries sorted in memory at once while building an
+## index, sorted runs are kept in temporary files and merged
+RUN_SIZE = 50000
+
+## Search modes
+SEARCH_EXACT = 'exact'
+SEARCH_PREFIX = 'prefix'
+SEARCH_REGEX = 'regex'
+SEARCH_MODES = (SEARCH_EXACT, SEARCH_PREFIX, SEARCH_REGEX)
+
+# magic, version, entries, blocks, packages, and the (mtime, size) of
+# the xml-info and synthesis files the index was built from:
+_HEADER = struct.Struct('>8sIIIIdQdQ')
+_OFFSET = struct.Struct('>I')
+_LENGTH = struct.Struct('>H')
+_ENTRY = struct.Struct('>HHI')
+_FN_RE = re.compile('fn="([^"]*)"')
+# regex characters which are not literal:
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+
+log = logging.getLogger('mdvpkgd.urpmi.files')
+
+
+class FileIndexError(Exception):
+    pass
+
+
+def media_stamp(media):
+    """Return the (mtime, size) of the xml-info and synthesis files of
+    a media, or None if it has no xml-info file.
+    """
+    try:
+        files = os.stat(media.files_path)
+        synthesis = os.stat(media.hdlist_path)
+    except OSError:
+        return None
+    return (files.st_mtime, files.st_size,
+            synthesis.st_mtime, synthesis.st_size)
+
+
+def build_index(media, path):
+    """Build the index of a media at path.
+
+    This is a co-routine, yielding every STEP xml-info lines read.
+    """
+    stamp = media_stamp(media)
+    if stamp is None:
+        raise FileIndexError('%s has no file list' % media.name)
+    log.info('building file index of %s', media.name)
+
+    ## Package versions by fullname, as named in the xml-info file ...
+    versions = {}
+    for (count, package_data) in enumerate(media.list()):
+        versions[package_data['fullname']] = (package_data['name'],
+                                              package_data['version'],
+                                              package_data['release'],
+                                              package_data['arch'])
+        if count % STEP == 0:
+            yield
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0755)
+
+    ## Read package file lists, in sorted runs of entries ...
+    ids = {}
+    packages = []
+    entries = []
+    runs = []
+    size = 0
+    package_id = None
+    proc = subprocess.Popen(['xz', '-dc', media.files_path],
+                            stdin=open(os.devnull),
+                            stdout=subprocess.PIPE,
+                            close_fds=True)
+    try:
+        for (count, line) in enumerate(proc.stdout):
+            line = line.rstrip('\n')
+            # tags may share lines with paths:
+            while line:
+                if line.startswith('<'):
+                    end = line.find('>') + 1 or len(line)
+                    tag, line = line[:end], line[end:]
+                    if not tag.startswith('<files'):
+                        continue
+                    match = _FN_RE.search(tag)
+                    if match is None:
+                        package_id = None
+                        continue
+                    fullname = _unescape(match.group(1))
+                    package_id = ids.get(fullname)
+                    if package_id is None:
+                        package_id = ids[fullname] = len(packages)
+                        packages.append(versions.get(fullname)
+                                        or (fullname, '', '', ''))
+                else:
+                    end = line.find('<')
+                    if end == -1:
+                        end = len(line)
+                    file_path, line = line[:end], line[end:]
+                    if package_id is not None and file_path:
+                        entries.append((_unescape(file_path), package_id))
+            if len(entries) >= RUN_SIZE:
+                runs.append(_write_run(directory, entries))
+                size += len(entries)
+                entries = []
+                yield
+            elif count % STEP == 0:
+                yield
+        proc.stdout.close()
+        status = proc.wait()
+        if status != 0:
+            raise FileIndexError('failed to decompress %s (status %s)'
+                                 % (media.files_path, status))
+        if entries:
+            runs.append(_write_run(directory, entries))
+            size += len(entries)
+            entries = []
+        for step in _write_index(path, stamp, packages, runs, size):
+            yield
+    finally:
+        if proc.returncode is None:
+            proc.stdout.close()
+            proc.wait()
+        for run in runs:
+            run.close()
+    log.info('file index of %s built: %s files of %s packages',
+             media.name,
+             size,
+             len(packages))
+
+
+def _unescape(text):
+    if '&' in text:
+        return xml.sax.saxutils.unescape(text, {'&quot;': '"',
+                                                '&apos;': "'"})
+    return text
+
+
+def _write_run(directory, entries):
+    """Sort entries and write them to a temporary file, returned."""
+    entries.sort()
+    run = tempfile.TemporaryFile(dir=directory)
+    # paths have no new lines, they're read line by line:
+    run.writelines('%s\0%d\n' % entry for entry in entries)
+    return run
+
+
+def _read_run(run):
+    run.seek(0)
+    for line in run:
+        (file_path, package_id) = line[:-1].rsplit('\0', 1)
+        yield (file_path, int(package_id))
+
+
+def _write_index(path, stamp, packages, runs, size):
+    """Write the index of the size entries of the sorted runs.
+
+    This is a co-routine, yielding every STEP entries written.
+    """
+    blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    offset = _HEADER.size + _OFFSET.size * (blocks + len(packages))
+
+    package_offsets = []
+    package_chunks = []
+    for versions in packages:
+        record = '\0'.join(versions)
+        package_offsets.append(offset)
+        package_chunks.append(_LENGTH.pack(len(record)) + record)
+        offset += _LENGTH.size + len(record)
+
+    tmp_path = '%s.%s' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as output:
+            ## Entries first, since block offsets are known once
+            ## they're written ...
+            output.seek(offset)
+            block_offsets = []
+            entry_chunks = []
+            previous = ''
+            entries = heapq.merge(*[ _read_run(run) for run in runs ])
+            for (i, (file_path, package_id)) in enumerate(entries):
+                if i % BLOCK_SIZE == 0:
+                    block_offsets.append(offset)
+                    shared = 0
+                else:
+                    shared = min(len(os.path.commonprefix((previous,
+                                                           file_path))),
+                                 0xffff)
+                suffix = file_path[shared:]
+                entry_chunks.append(_ENTRY.pack(shared,
+                                                len(suffix),
+                                                package_id)
+                                    + suffix)
+                offset += _ENTRY.size + len(suffix)
+                previous = file_path
+                if i % STEP == STEP - 1:
+                    output.write(''.join(entry_chunks))
+                    entry_chunks = []
+                    yield
+            output.write(''.join(entry_chunks))
+
+            output.seek(0)
+            output.write(_HEADER.pack(INDEX_MAGIC,
+                                      INDEX_VERSION,
+                                      size,
+                                      blocks,
+                                      len(packages),
+                                      *stamp))
+            output.write(struct.pack('>%dI' % blocks, *block_offsets))
+            output.write(struct.pack('>%dI' % len(packages),
+                                     *package_offsets))
+            output.write(''.join(package_chunks))
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _literal_prefix(pattern):
+    """Return the text all paths matched by a regex must start with,
+    '' if the regex isn't anchored with '^'.
+    """
+    if not pattern.startswith('^') or '|' in pattern:
+        return ''
+    prefix = []
+    for char in pattern[1:]:
+        if char in _REGEX_SPECIAL:
+            if char in '*?{' and prefix:
+                # the previous character is optional:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class FileIndex(object):
+    """A media file path index, read through mmap."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            if os.fstat(index_file.fileno()).st_size < _HEADER.size:
+                raise FileIndexError('truncated file index: %s' % path)
+            self._map = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        header = _HEADER.unpack_from(self._map, 0)
+        if header[:2] != (INDEX_MAGIC, INDEX_VERSION):
+            raise FileIndexError('unknown file index format: %s' % path)
+        (self.entries, self._blocks, self.packages) = header[2:5]
+        self.stamp = header[5:]
+        self._packages_at = _HEADER.size + _OFFSET.size * self._blocks
+
+    def package(self, package_id):
+        """Return the (name, version, release, arch) of a package."""
+        (offset,) = _OFFSET.unpack_from(self._map,
+                                        self._packages_at
+                                        + _OFFSET.size * package_id)
+        (length,) = _LENGTH.unpack_from(self._map, offset)
+        offset += _LENGTH.size
+        return tuple(self._map[offset:offset + length].split('\0'))
+
+    def search(self, mode, pattern):
+        """Search paths matching pattern: equal to it (SEARCH_EXACT),
+        starting with it (SEARCH_PREFIX), or matching the regex it is
+        (SEARCH_REGEX, anywhere in the path).
+
+        Yield lists of (path, package id) of matching paths, one for
+        every STEP paths read.  Regexes anchored with '^' and starting
+        with some literal text only read paths starting with it.
+        """
+        if mode == SEARCH_EXACT:
+            start = pattern
+            match = lambda path: path == pattern
+            done = lambda path: path > pattern
+        elif mode == SEARCH_PREFIX:
+            start = pattern
+            match = lambda path: path.startswith(pattern)
+            done = lambda path: not path.startswith(pattern)
+        elif mode == SEARCH_REGEX:
+            regex = re.compile(pattern)
+            start = _literal_prefix(pattern)
+            match = lambda path: regex.search(path) is not None
+            done = lambda path: not path.startswith(start)
+        else:
+            raise ValueError('unknown search mode: %s' % mode)
+        matches = []
+        for (count, (path, package_id)) in enumerate(self._scan(start)):
+            if path < start:
+                continue
+            if done(path):
+                break
+            if match(path):
+                matches.append((path, package_id))
+            if count % STEP == STEP - 1:
+                yield matches
+                matches = []
+        yield matches
+
+    def _scan(self, key):
+        """Yield (path, package id) of all entries from the block
+        where key would be.
+        """
+        block = self._find_block(key)
+        if block >= self._blocks:
+            return
+        offset = self._block_offset(block)
+        path = ''
+        for i in xrange(block * BLOCK_SIZE, self.entries):
+            (shared, length, package_id) = _ENTRY.unpack_from(self._map,
+                                                              offset)
+            offset += _ENTRY.size
+            path = path[:shared] + self._map[offset:offset + length]
+            offset += length
+            yield (path, package_id)
+
+    def _find_block(self, key):
+        """Return the last block whose first path is not after key."""
+        (low, high) = (0, self._blocks)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._first_path(middle) <= key:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def _block_offset(self, block):
+        return _OFFSET.unpack_from(self._map,
+                                   _HEADER.size + _OFFSET.size * block)[0]
+
+    def _first_path(self, block):
+        offset = self._block_offset(block)
+        (shared, length, package_id) = _ENTRY.unpack_from(self._map, offset)
+        offset += _ENTRY.size
+        return self._map[offset:offset + length]
+
+
+class FileIndexes(object):
+    """File indexes of medias, kept in a directory."""
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+        self._indexes = {}  # media name -> FileIndex
+        self._errors = {}  # media name -> why it has no index
+        self._building = set()
+
+    def get(self, media_name):
+        """Return the index of a media, None if it has no file list
+        (see update() and error()).
+        """
+        return self._indexes.get(media_name)
+
+    def error(self, media_name):
+        """Return why a media has no index after update()."""
+        return self._errors.get(media_name)
+
+    def update(self, media):
+        """Open the index of a media, building it first if it's
+        missing or outdated.
+
+        This is a co-routine, yielding while the index is built.
+        """
+        while media.name in self._building:
+            # another task is building it:
+            yield
+        stamp = media_stamp(media)
+        if stamp is None:
+            self._indexes.pop(media.name, None)
+            # urpmi fetches xml-info of remote medias only on demand,
+            # by default:
+            self._errors[media.name] = ('no file list (%s)'
+                                        % media.files_path)
+            return
+        self._errors.pop(media.name, None)
+        index = self._indexes.get(media.name)
+        if index is not None and index.stamp == stamp:
+            return
+        path = os.path.join(self.directory,
+                            '%s.idx' % media.name.replace('/', '%2F'))
+        if index is None:
+            index = self._open(path)
+            if index is not None and index.stamp == stamp:
+                self._indexes[media.name] = index
+                return
+        # indexes being searched are closed when no more used:
+        self._indexes.pop(media.name, None)
+        self._building.add(media.name)
+        try:
+            for step in build_index(media, path):
+                yield
+        except (EnvironmentError, FileIndexError) as e:
+            log.error('failed to build file index of %s: %s', media.name, e)
+            self._errors[media.name] = 'failed to build file index: %s' % e
+            return
+        finally:
+            self._building.discard(media.name)
+        index = self._open(path)
+        if index is not None:
+            self._indexes[media.name] = index
+        else:
+            self._errors[media.name] = 'failed to open file index'
+
+    def _open(self, path):
+        try:
+            return FileIndex(path)
+        except EnvironmentError as e:
+            if os.path.exists(path):
+                log.warning('failed to open file index: %s', e)
+        except FileIndexError as e:
+            log.warning('%s', e)
+        return None
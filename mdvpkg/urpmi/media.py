@@ -48,6 +48,10 @@ class UrpmiMedia(gobject.GObject):
             data_dir,
             '%s/synthesis.hdlist.cz' % name
         )
+        self._files_path = os.path.join(
+            data_dir,
+            '%s/files.xml.lzma' % name
+        )
 
         # name-version-release.arch regexp:
         self._nvra_re = re.compile('^(?P<name>.+)-'
@@ -59,6 +63,16 @@ class UrpmiMedia(gobject.GObject):
                                       '(?:\[\*])*(?:\[(?P<cond>[<>=]*)'
                                       ' *(?P<ver>.*)])?')
 
+    @property
+    def hdlist_path(self):
+        """Path of the media synthesis file."""
+        return self._hdlist_path
+
+    @property
+    def files_path(self):
+        """Path of the media xml-info file with package file lists."""
+        return self._files_path
+
     def list(self):
         """Open the hdlist file and yields package data in it."""
         with self._open(self._hdlist_path, 'r') as hdlist:
@@ -72,6 +86,7 @@ class UrpmiMedia(gobject.GObject):
 			pkg['distepoch'] = fields[6]
                     except IndexError:
                         pass
+                    pkg['fullname'] = fields[1]
                     pkg.update(zip(('name', 'version', 'release', 'arch'),
                                    self.parse_rpm_name(
                                        fields[1],
@@ -0,0 +1,132 @@
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): J. Victor Martins <jvdm@mandriva.com>
+##
+"""Inverted text index of package names and summaries."""
+
+
+import re
+import math
+import bisect
+
+
+## Weight of words found in package names and summaries
+NAME_WEIGHT = 3.0
+SUMMARY_WEIGHT = 1.0
+## Weight of query terms matching only the start of words
+PREFIX_WEIGHT = 0.5
+## Number of entries indexed between yields of build()
+STEP = 500
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the list of lower case words of a text (unicode or utf-8
+    encoded).
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return _WORD_RE.findall(text.lower())
+
+
+class TextIndex(object):
+    """Map words of package names and summaries to the package entries
+    (by name) having them, with the weight of the word in the entry.
+
+    Entries are indexed with the summaries of all their versions, and
+    must be updated whenever their versions change.
+    """
+
+    def __init__(self):
+        self._postings = {}  # word -> {package name: weight}
+        self._documents = {}  # package name -> words
+        self._words = []  # sorted words, for prefix matches
+
+    def __len__(self):
+        return len(self._documents)
+
+    def build(self, entries):
+        """Index all package entries, replacing the current index.
+
+        This is a co-routine, yielding every STEP entries indexed.
+        """
+        self._postings = {}
+        self._documents = {}
+        for (count, entry) in enumerate(entries):
+            self._add(entry)
+            if count % STEP == STEP - 1:
+                yield
+        self._words = sorted(self._postings)
+
+    def update(self, name, entry):
+        """Index the new versions of a package entry, or remove it if
+        entry is None.
+        """
+        for word in self._documents.pop(name, ()):
+            postings = self._postings[word]
+            del postings[name]
+            if not postings:
+                del self._postings[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+        if entry is not None:
+            for word in self._add(entry):
+                if len(self._postings[word]) == 1:
+                    bisect.insort(self._words, word)
+
+    def search(self, query):
+        """Return the names of the package entries matching words of
+        query, best matches first.
+
+        Entries are scored by the sum of the weights of the words they
+        match, scaled by the rarity of the word in the index.  Words
+        starting with a query term match it with PREFIX_WEIGHT.
+        """
+        scores = {}
+        documents = max(len(self._documents), 1)
+        for term in set(tokenize(query)):
+            start = bisect.bisect_left(self._words, term)
+            for word in self._words[start:]:
+                if not word.startswith(term):
+                    break
+                postings = self._postings[word]
+                weight = math.log(1.0 + float(documents) / len(postings))
+                if word != term:
+                    weight *= PREFIX_WEIGHT
+                for (name, word_weight) in postings.iteritems():
+                    scores[name] = (scores.get(name, 0.0)
+                                    + weight * word_weight)
+        return sorted(scores, key=lambda name: (-scores[name], name))
+
+    def _add(self, entry):
+        """Index an entry, returning its words."""
+        weights = {}
+        for word in tokenize(entry.name):
+            weights[word] = weights.get(word, 0.0) + NAME_WEIGHT
+        summary_words = set()
+        for versions in (entry.installs, entry.upgrades):
+            for package in versions.itervalues():
+                summary_words.update(tokenize(package.summary))
+        for word in summary_words:
+            weights[word] = weights.get(word, 0.0) + SUMMARY_WEIGHT
+        for (word, weight) in weights.iteritems():
+            self._postings.setdefault(word, {})[entry.name] = weight
+        self._documents[entry.name] = tuple(weights)
+        return weights
@@ -0,0 +1,151 @@
+##
+## Copyright (C) 2010-2011 Mandriva S.A <http://www.mandriva.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): J. Victor Martins <jvdm@mandriva.com>
+##
+"""Concurrent signature and digest verification of package files."""
+
+
+import os
+import re
+import collections
+import logging
+import subprocess
+import gobject
+
+
+log = logging.getLogger('mdvpkgd.verify')
+
+## Signature lines of verbose checksig output, with the signing key
+## id (e.g. "V4 RSA/SHA256 Signature, key ID 80420f66: OK", or
+## "V3 DSA signature: OK, key ID 26752624" for rpm < 4.14)
+_SIGNATURE_RE = re.compile(r'signature.*key ID ([0-9a-f]+)', re.I)
+## Words of checksig output lines reporting a failed check
+_FAILURES = ('NOT OK', 'BAD', 'NOKEY', 'NOTTRUSTED', 'MISSING')
+
+
+def default_workers():
+    """Number of concurrent verifications, one per processor."""
+    try:
+        return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (ValueError, OSError):
+        return 1
+
+
+def checksig_command():
+    """Command checking signatures and digests of rpm files, rpmkeys
+    if available (rpm >= 4.9), or rpm.
+    """
+    for path in os.environ.get('PATH', '/bin:/usr/bin').split(os.pathsep):
+        if os.access(os.path.join(path, 'rpmkeys'), os.X_OK):
+            return ['rpmkeys', '--checksig', '-v']
+    return ['rpm', '-Kv']
+
+
+def check_output(output, key_ids):
+    """Return an error message if verbose checksig output doesn't show
+    valid digests and signatures, all made with one of key_ids (hex
+    key ids, as in urpmi media key-ids), or None if it does.
+    """
+    signed = False
+    # the first line is the file name:
+    for line in output.splitlines()[1:]:
+        line = line.strip()
+        if not line:
+            continue
+        for failure in _FAILURES:
+            if failure in line:
+                return line
+        match = _SIGNATURE_RE.search(line)
+        if match is not None:
+            # rpm shows the short (8 digits) or long key id:
+            key_id = match.group(1).lower()
+            if not [ k for k in key_ids if key_id.endswith(k[-8:]) ]:
+                return 'signed with a key not allowed for its media: %s' \
+                           % key_id
+            signed = True
+    if not signed:
+        return 'package is not signed'
+    return None
+
+
+class Verifier(object):
+    """Check rpm files with at most `workers` concurrent rpmkeys (or
+    rpm) processes.
+
+    Processes are watched from the main loop, so no threads are
+    needed.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = default_workers()
+        self.workers = workers
+        self._command = checksig_command()
+        self._queue = collections.deque()
+        self._running = 0
+
+    def verify(self, path, key_ids, callback):
+        """Verify the rpm file at path is signed with one of key_ids,
+        callback(path, error) is called with an error message, or None
+        if the file is valid.
+        """
+        key_ids = [ key_id.lower() for key_id in key_ids ]
+        self._queue.append((path, key_ids, callback))
+        self._start_next()
+
+    def _start_next(self):
+        while self._queue and self._running < self.workers:
+            (path, key_ids, callback) = self._queue.popleft()
+            try:
+                proc = subprocess.Popen(self._command + [path],
+                                        stdin=open(os.devnull),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        close_fds=True)
+            except OSError as e:
+                callback(path, 'failed to run %s: %s' % (self._command[0],
+                                                         e))
+                continue
+            self._running += 1
+            gobject.child_watch_add(proc.pid,
+                                    self._on_exit,
+                                    (proc, path, key_ids, callback))
+
+    def _on_exit(self, pid, condition, data):
+        (proc, path, key_ids, callback) = data
+        self._running -= 1
+        # output is a few lines, it fits in the pipe buffer:
+        output = proc.stdout.read().strip()
+        proc.stdout.close()
+        # the process was reaped by the child watch:
+        if os.WIFEXITED(condition):
+            proc.returncode = os.WEXITSTATUS(condition)
+        else:
+            proc.returncode = -os.WTERMSIG(condition)
+        if proc.returncode != 0:
+            error = output or 'verification failed'
+        else:
+            error = check_output(output, key_ids)
+        if error is not None:
+            log.warning('verification failed: %s: %s', path, error)
+        else:
+            log.debug('verified: %s', path)
+        self._start_next()
+        callback(path, error)
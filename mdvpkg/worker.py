@@ -28,10 +28,50 @@ import os
 import signal
 import collections
 import logging
+import time
+import errno
+import fcntl
+import json
 
+import mdvpkg
 import mdvpkg.tasks
+import mdvpkg.download
+import mdvpkg.verify
+import mdvpkg.stats
+import mdvpkg.profiling
 
 
+## Version of the protocol spoken with the backend
+BACKEND_PROTOCOL_VERSION = 1
+## Maximum number of digits in a frame length
+MAX_FRAME_LENGTH_DIGITS = 9
+## Default maximum rate of progress signals for each item (per second)
+DEFAULT_PROGRESS_RATE = mdvpkg.DEFAULT_PROGRESS_RATE
+## Backend progress signals, and the index of the argument naming the
+## item progress is reported for (None if there's a single item)
+PROGRESS_SIGNALS = {'Download': 0,
+                    'Install': 0,
+                    'Preparing': None}
+## Backend signals about a package, routed to the tasks requesting it
+## when tasks are merged
+ROUTED_SIGNALS = ('DownloadStart', 'Download', 'DownloadDone',
+                  'DownloadError', 'VerifyError', 'InstallStart', 'Install')
+## Maximum number of cached dependency resolutions
+RESOLUTION_CACHE_SIZE = 64
+## Backend restart delay after it exits (seconds), doubled up to
+## BACKEND_MAX_RESTART_DELAY while it keeps failing
+BACKEND_RESTART_DELAY = 1
+BACKEND_MAX_RESTART_DELAY = 60
+## Maximum number of read-only tasks running at the same time
+MAX_READERS = 8
+## Run time estimated for tasks of a class never run before (seconds)
+DEFAULT_RUN_ESTIMATE = 1.0
+## Weight of the last run time in task classes run time estimates
+RUN_ESTIMATE_WEIGHT = 0.3
+## Minimum interval between updates of queued tasks positions
+## (milliseconds)
+POSITIONS_INTERVAL = 500
+
 log = logging.getLogger('mdvpkgd.worker')
 
 
@@ -39,14 +79,165 @@ class BackendError(Exception):
     pass
 
 
+class BackendProtocolError(Exception):
+    pass
+
+
+class TaskRequeued(Exception):
+    """Thrown in the monitor of a task which must be queued again, to
+    be run alone.
+    """
+
+
+def encode_frame(message):
+    """Encode a message as a JSON netstring frame."""
+    data = json.dumps(message)
+    return '%d:%s,' % (len(data), data)
+
+
+def decode_frames(buffer):
+    """Decode all complete JSON netstring frames in buffer.
+
+    Return a (messages, rest) tuple, where rest is the data of
+    incomplete frames at the end of buffer.  Messages are objects with
+    a string `tag` and an optional `args` list.
+    """
+    messages = []
+    pos = 0
+    while True:
+        colon = buffer.find(':', pos, pos + MAX_FRAME_LENGTH_DIGITS + 1)
+        if colon == -1:
+            if len(buffer) - pos > MAX_FRAME_LENGTH_DIGITS:
+                raise BackendProtocolError('bad frame length')
+            break
+        length = buffer[pos:colon]
+        if not length.isdigit():
+            raise BackendProtocolError('bad frame length: %r' % length)
+        end = colon + 1 + int(length)
+        if len(buffer) <= end:
+            break
+        if buffer[end] != ',':
+            raise BackendProtocolError('missing frame terminator')
+        try:
+            message = json.loads(buffer[colon + 1:end])
+        except ValueError as e:
+            raise BackendProtocolError('bad frame data: %s' % e)
+        if (not isinstance(message, dict)
+                or not isinstance(message.get('tag'), basestring)
+                or not isinstance(message.get('args', []), list)):
+            raise BackendProtocolError('malformed message: %r'
+                                       % buffer[colon + 1:end][:80])
+        messages.append(message)
+        pos = end + 1
+    return messages, buffer[pos:]
+
+
+class ProgressCoalescer(object):
+    """Rate limit task progress signals.
+
+    Progress signals for each item (e.g. the file being downloaded)
+    are emitted at most `rate` times per second, with their latest
+    values.  Other signals are emitted right away, after any pending
+    progress, so start, done and error events keep their order.
+    """
+
+    def __init__(self, rate=DEFAULT_PROGRESS_RATE):
+        if rate > 0:
+            self.interval = 1.0 / rate
+        else:
+            self.interval = 0
+        # (task, signal, item) -> latest args, in arrival order:
+        self._pending = collections.OrderedDict()
+        self._last = {}  # (task, signal, item) -> last emission time
+        self._source = None
+
+    def signal(self, task, name, args):
+        """Emit or delay a task signal."""
+        if name not in PROGRESS_SIGNALS or not self.interval:
+            self.flush()
+            getattr(task, name)(*args)
+            return
+        index = PROGRESS_SIGNALS[name]
+        if index is None:
+            key = (task, name, None)
+        else:
+            key = (task, name, args[index])
+        now = time.time()
+        if (key not in self._pending
+                and now - self._last.get(key, 0) >= self.interval):
+            self._last[key] = now
+            getattr(task, name)(*args)
+        else:
+            if key in self._pending:
+                mdvpkg.stats.incr('backend.progress_coalesced')
+            self._pending[key] = args
+            if self._source is None:
+                self._source = gobject.timeout_add(
+                                   int(self.interval * 1000),
+                                   self._emit_pending
+                               )
+
+    def flush(self):
+        """Emit all pending progress signals."""
+        if self._source is not None:
+            gobject.source_remove(self._source)
+            self._source = None
+        self._emit(self._pending.keys())
+
+    def reset(self):
+        """Forget emission times, after the task is done."""
+        self.flush()
+        self._last.clear()
+
+    def _emit(self, keys):
+        now = time.time()
+        for key in keys:
+            (task, name, _) = key
+            self._last[key] = now
+            getattr(task, name)(*self._pending.pop(key))
+
+    def _emit_pending(self):
+        """Timeout callback to emit progress signals due."""
+        deadline = time.time() - self.interval
+        self._emit([key for key in self._pending
+                        if self._last.get(key, 0) <= deadline])
+        if not self._pending:
+            self._source = None
+            return False
+        return True
+
+
 class Backend(object):
-    """Represents a urpmi backend process instance."""
+    """Represents a urpmi backend process instance.
+
+    Messages from and to the backend are JSON objects framed as
+    netstrings (`<length>:<data>,`).  The backend first sends HELLO
+    with its protocol version, and we send it a hello command with
+    ours, so both sides can refuse incompatible versions.
+
+    A supervised backend is kept running and warm: it's restarted
+    when it exits (with an exponential backoff delay while it keeps
+    failing), and asked to reload urpmi media configuration only when
+    it changes.
 
-    def __init__(self, path):
+    Progress signals from the backend are coalesced to at most
+    `progress_rate` signals per second for each item (see
+    ProgressCoalescer).
+    """
+
+    def __init__(self, path, progress_rate=DEFAULT_PROGRESS_RATE):
         self.path = path        
+        self._progress = ProgressCoalescer(progress_rate)
         self.proc = None
+        self.ready = False
+        self.supervised = False
         self._task = None
         self._runner_gen = None
+        self._watches = []
+        self._restart_delay = BACKEND_RESTART_DELAY
+        self._restart_source = None
+        self._reload_pending = False
+        self._buffer = ''
 
     @property
     def running(self):
@@ -58,138 +249,844 @@ class Backend(object):
         """ Starts the backend's process. """
         if self.running:
             raise Exception, 'backend already running'
+        if self._restart_source is not None:
+            gobject.source_remove(self._restart_source)
+            self._restart_source = None
+        self.ready = False
+        self._reload_pending = False
+        self._buffer = ''
         self.proc = subprocess.Popen('',
                                      executable=self.path,
                                      stdin=subprocess.PIPE,
                                      stdout=subprocess.PIPE)
-        gobject.io_add_watch(self.proc.stdout,
-                             gobject.IO_IN | gobject.IO_PRI,
-                             self._reply_callback)
-        gobject.io_add_watch(self.proc.stdout,
-                             gobject.IO_ERR | gobject.IO_HUP,
-                             self._error_callback)
+        # read replies without blocking:
+        fd = self.proc.stdout.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._watches = [
+            gobject.io_add_watch(self.proc.stdout,
+                                 gobject.IO_IN | gobject.IO_PRI,
+                                 self._reply_callback),
+            gobject.io_add_watch(self.proc.stdout,
+                                 gobject.IO_ERR | gobject.IO_HUP,
+                                 self._error_callback),
+        ]
+        log.info('backend started: %s', self.proc.pid)
+        self._send_command('hello', BACKEND_PROTOCOL_VERSION)
+
+    def supervise(self):
+        """Start the backend and keep it running."""
+        self.supervised = True
+        if not self.running:
+            self.start()
 
     def kill(self):
         """Send SIGTERM to the backend child and wait its death."""
+        self.supervised = False
+        if self._restart_source is not None:
+            gobject.source_remove(self._restart_source)
+            self._restart_source = None
         if not self.running:
             raise Exception, "kill() called and backend's not running"
         self.proc.send_signal(signal.SIGTERM)
-        # wait for child to terminate
-        self.proc.communicate()
-        self.proc = None
-        log_backend.debug('Backend killed')
+        self._reap()
+        log.debug('Backend killed')
+
+    def reload(self):
+        """Make the backend reload urpmi media configuration."""
+        if not self.running:
+            # configuration will be read when started
+            return
+        self.ready = False
+        if self._task:
+            self._reload_pending = True
+        else:
+            log.info('reloading backend media configuration')
+            self._send_command('reload')
+
+    def install_packages(self, runner_gen, task, names, verified=False):
+        """Install packages, with verified the packages to install
+        were already verified and urpmi won't check them again.
+        """
+        if verified:
+            command = 'install_verified_packages'
+        else:
+            command = 'install_packages'
+        self._send_task(runner_gen, task, command, *names)
+
+    def resolve_packages(self, runner_gen, task, names):
+        """Resolve dependencies of installing packages, the result is
+        passed to task.on_result().
+        """
+        self._send_task(runner_gen, task, 'resolve_packages', *names)
 
-    def install_packages(self, runner_gen, task, names):
+    def _send_task(self, runner_gen, task, task_name, *args):
         if self._task:
             raise Exception, 'already running a task'
         self._task = task
         self._runner_gen = runner_gen
-        self._send_task('install_packages', *names)
-
-    def _send_task(self, task_name, *args):
         if not self.running:
             self.start()
-        self.proc.stdin.write("%s\t%s\n" % (task_name, '\t'.join(args)))
+        self._send_command(task_name, *args)
+
+    def _send_command(self, task_name, *args):
+        frame = encode_frame({'task': task_name, 'args': args})
+        self.proc.stdin.write(frame)
+        mdvpkg.stats.incr('backend.commands')
+        mdvpkg.stats.incr('backend.bytes_sent', len(frame))
+
+    def _reap(self):
+        """Wait the backend process to terminate and forget it."""
+        for watch in self._watches:
+            gobject.source_remove(watch)
+        self._watches = []
+        # wait for child to terminate
+        self.proc.communicate()
+        log.info('backend exited: %s', self.proc.returncode)
+        self.proc = None
+        self.ready = False
+
+    def _schedule_restart(self):
+        log.info('restarting backend in %s seconds', self._restart_delay)
+        mdvpkg.stats.incr('backend.restarts')
+        self._restart_source = gobject.timeout_add_seconds(
+                                   self._restart_delay,
+                                   self._restart
+                               )
+        self._restart_delay = min(2 * self._restart_delay,
+                                  BACKEND_MAX_RESTART_DELAY)
+
+    def _restart(self):
+        """Timeout callback to restart the backend."""
+        self._restart_source = None
+        if self.supervised and not self.running:
+            try:
+                self.start()
+            except OSError as e:
+                log.error('failed to start backend: %s', e)
+                self._schedule_restart()
+        return False
 
     #
     # Backend I/O callbacks
     #
 
     def _reply_callback(self, stdout, condition):
-        # readline() may block, but we're expecting backend process to
-        # always emit data linewise, so if there is data a line will
-        # come shortly:            
-        line = stdout.readline()
-        if line.startswith('%MDVPKG\t') and self._task:
-            tag, arg_str = line.rstrip('\n').split('\t', 2)[1:]
+        try:
+            if isinstance(self._task, mdvpkg.tasks.TaskBase):
+                # profile replies as part of the task they're sent for:
+                mdvpkg.profiling.call(self._task, self._read_messages)
+            else:
+                # replies of pipelined or merged tasks, or to no task:
+                self._read_messages()
+        except BackendProtocolError as e:
+            log.error('backend protocol error: %s', e)
+            self._backend_failed('backend protocol error: %s' % e)
+        return True
+
+    def _error_callback(self, stdout, condition):
+        try:
+            # handle replies sent before the error:
+            self._read_messages()
+        except BackendProtocolError as e:
+            log.error('backend protocol error: %s', e)
+        log.error('backend pipe error')
+        self._backend_failed('backend pipe error')
+        # our watches were already removed
+        return True
+
+    def _read_messages(self):
+        """Read all available data and handle complete messages."""
+        fd = self.proc.stdout.fileno()
+        chunks = [self._buffer]
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            chunks.append(data)
+            mdvpkg.stats.incr('backend.bytes_received', len(data))
+        messages, self._buffer = decode_frames(''.join(chunks))
+        mdvpkg.stats.incr('backend.messages', len(messages))
+        for message in messages:
+            if self.proc is None:
+                # backend was killed by a previous message
+                break
+            self._handle_message(message['tag'], message.get('args', []))
+
+    def _handle_message(self, tag, args):
+        if tag in {'HELLO', 'READY'}:
+            getattr(self, '_handle_%s' % tag)(args)
+        elif self._task:
             try:
                 handler = getattr(self, '_handle_%s' % tag)
             except AttributeError:
                 self._handle_EXCEPTION(
-                    'unknown response from backend: %s' % tag
+                    ['unknown response from backend: %s' % tag]
                 )
+                self._clean()
             else:
-                handler(eval(arg_str))
-                if tag != 'SIGNAL':
+                handler(args)
+                if tag not in {'SIGNAL', 'RESULT'}:
                     self._clean()
-        return True
 
-    def _error_callback(self, stdout, condition):
-        self._handle_EXCEPTION('backend pipe error')
-        self._clean()
-        self.kill()
+    def _backend_failed(self, message):
+        """Abort the current task and restart the backend."""
+        mdvpkg.stats.incr('backend.failures')
+        if self._task:
+            self._handle_EXCEPTION([message])
+            self._clean()
+        if self.running:
+            self.proc.send_signal(signal.SIGTERM)
+        self._reap()
+        if self.supervised:
+            self._schedule_restart()
 
     def _clean(self):
+        self._progress.reset()
         self._task = None
         self._runner_gen = None
+        if self._reload_pending and self.running:
+            self._reload_pending = False
+            log.info('reloading backend media configuration')
+            self._send_command('reload')
 
     #
     # Response handlers
     #
 
+    def _handle_HELLO(self, args):
+        version = args[0]
+        if version != BACKEND_PROTOCOL_VERSION:
+            log.critical('backend protocol version %s is not supported',
+                         version)
+            # restarting won't help:
+            self.supervised = False
+            self._backend_failed('unsupported backend protocol version')
+
+    def _handle_READY(self, args):
+        log.info('backend is ready')
+        self.ready = True
+        self._restart_delay = BACKEND_RESTART_DELAY
+
     def _handle_SIGNAL(self, args):
-        signal_name = args[0]
-        args = args[1:]
-        getattr(self._task, signal_name)(*args)
+        self._progress.signal(self._task, args[0], args[1:])
+
+    def _handle_RESULT(self, args):
+        self._task.on_result(*args)
 
     def _handle_EXCEPTION(self, args):
+        self._progress.flush()
         try:
             self._runner_gen.throw(BackendError, args[0])
         except StopIteration:
             pass
 
     def _handle_ERROR(self, args):
-        self._runner_gen.send(*args)
+        self._progress.flush()
+        try:
+            self._runner_gen.send(tuple(args))
+        except StopIteration:
+            pass
 
     def _handle_DONE(self, args):
         log.debug('done received')
+        self._progress.flush()
         self._runner_gen.close()
         log.debug('generator closed')
 
 
+class ResolutionCache(object):
+    """Dependency resolutions of the most recently requested package
+    names, for each state of the system (e.g. the package cache
+    generation and the rpmdb fingerprint).
+    """
+
+    def __init__(self, size=RESOLUTION_CACHE_SIZE):
+        self.size = size
+        # (names, state) -> resolution, in LRU order:
+        self._resolutions = collections.OrderedDict()
+
+    def get(self, names, state):
+        """Return a cached resolution or None."""
+        key = (frozenset(names), state)
+        resolution = self._resolutions.pop(key, None)
+        if resolution is not None:
+            self._resolutions[key] = resolution
+        return resolution
+
+    def put(self, names, state, resolution):
+        key = (frozenset(names), state)
+        self._resolutions.pop(key, None)
+        self._resolutions[key] = resolution
+        while len(self._resolutions) > self.size:
+            self._resolutions.popitem(last=False)
+
+    def clear(self):
+        """Forget all resolutions, e.g. after the system has
+        changed.
+        """
+        self._resolutions.clear()
+
+
+class MonitorGroup(object):
+    """Forward the outcome of a backend call to the task monitors of
+    all tasks sharing it.
+
+    Like a task monitor, send() and throw() raise StopIteration when
+    the call must stop, i.e. when all the tasks have finished (e.g.
+    were cancelled).
+
+    If the call fails before installing (i.e. before `router` has
+    routed a downloading or installing state), the failure may come
+    from the packages of any of the tasks: they are queued again, to
+    be run alone, instead of failing all of them.
+    """
+
+    def __init__(self, monitors, router):
+        self._monitors = list(monitors)  # monitors of running tasks
+        self._router = router
+
+    def send(self, value):
+        if value is not None and self._can_split():
+            self._requeue()
+        else:
+            self._forward(lambda monitor: monitor.send(value))
+
+    def throw(self, *args):
+        if self._can_split():
+            self._requeue()
+        else:
+            self._forward(lambda monitor: monitor.throw(*args))
+
+    def _can_split(self):
+        return len(self._monitors) > 1 and not self._router.installing
+
+    def _requeue(self):
+        log.info('merged tasks failed before installing, '
+                 'queueing them again to run alone')
+        self._forward(lambda monitor: monitor.throw(TaskRequeued))
+
+    def _forward(self, call):
+        for monitor in list(self._monitors):
+            try:
+                call(monitor)
+            except StopIteration:
+                self._monitors.remove(monitor)
+        if not self._monitors:
+            raise StopIteration
+
+    def close(self):
+        for monitor in self._monitors:
+            monitor.close()
+
+
+class SignalRouter(object):
+    """Route signals of a backend call shared by several tasks.
+
+    Signals about a package (or its rpm file) go to the tasks that
+    requested it by name, other signals (e.g. about dependencies or
+    the whole transaction) go to all tasks.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        # True once packages are downloaded or installed:
+        self.installing = False
+        self._tasks_of = {}  # package name -> tasks
+        for task in tasks:
+            for name in task.names:
+                self._tasks_of.setdefault(name, []).append(task)
+
+    def __getattr__(self, signal_name):
+        def route(*args):
+            if (signal_name == 'StateChanged'
+                    and args[0] in (mdvpkg.tasks.STATE_DOWNLOADING,
+                                    mdvpkg.tasks.STATE_INSTALLING)):
+                self.installing = True
+            tasks = None
+            if args and signal_name in ROUTED_SIGNALS:
+                tasks = self._match(args[0])
+            for task in tasks or self.tasks:
+                getattr(task, signal_name)(*args)
+        return route
+
+    def _match(self, item):
+        """Tasks requesting the package named by a rpm file name or
+        a package full name.
+        """
+        if item.endswith('.rpm'):
+            item = item[:-len('.rpm')]
+        # name-version-release.arch, with an optional -disttag after
+        # the release:
+        for split in (2, 3):
+            fields = item.rsplit('-', split)
+            if len(fields) == split + 1 and fields[0] in self._tasks_of:
+                return self._tasks_of[fields[0]]
+        return None
+
+
+class StageMonitor(object):
+    """Task monitor for a backend call that is a stage of a task.
+
+    Errors are forwarded to the task monitor, but instead of finishing
+    the task when the call is done, `next_stage` is called.
+    """
+
+    def __init__(self, monitor, next_stage):
+        self._monitor = monitor
+        self._next_stage = next_stage
+
+    def send(self, value):
+        self._monitor.send(value)
+
+    def throw(self, *args):
+        self._monitor.throw(*args)
+
+    def close(self):
+        # the backend must be done with the call before next stage:
+        gobject.idle_add(self._next_stage)
+
+
+class InstallPipeline(object):
+    """Install packages in stages: dependencies are resolved by the
+    backend, packages from remote medias are downloaded concurrently
+    by the daemon into the urpmi cache, and then installed by the
+    backend (urpmi uses the cached files instead of downloading them).
+
+    With a verifier, each cached file is verified as soon as it's
+    downloaded, with the signing keys allowed for its media, and the
+    task fails at the first bad package.  When all packages were
+    verified the transaction doesn't verify them again.
+
+    `target` is the task (or a SignalRouter) receiving the signals.
+    Packages which failed to download are left for urpmi.
+    """
+
+    def __init__(self, monitor, target, names, backend, downloader,
+                 verifier=None):
+        self._monitor = monitor
+        self._target = target
+        self._names = names
+        self._backend = backend
+        self._downloader = downloader
+        self._verifier = verifier
+        self._files = []
+        self._paths = {}  # file name -> path
+        self._key_ids = {}  # path -> key ids allowed to sign it
+        self._download = None
+        self._downloading = False
+        self._verifying = 0
+        self._unverified = False
+        self._failed = False
+
+    def start(self):
+        self._backend.resolve_packages(StageMonitor(self._monitor,
+                                                    self._start_download),
+                                       self,
+                                       self._names)
+
+    def __getattr__(self, name):
+        # signals of the resolve stage:
+        return getattr(self._target, name)
+
+    def on_result(self, install, remove):
+        """Backend has resolved dependencies."""
+        self._files = [ (pkg['url'], pkg['path'], pkg['filesize'])
+                            for pkg in install if pkg.get('url') ]
+        self._key_ids = dict([ (pkg['path'], pkg.get('key_ids', []))
+                                   for pkg in install ])
+        # packages from local medias are left for urpmi to verify:
+        self._unverified = len(self._files) < len(install)
+
+    def _resume(self):
+        """Check if the task is still running."""
+        if self._failed:
+            return False
+        try:
+            self._monitor.send(None)
+        except StopIteration:
+            return False
+        return True
+
+    def _start_download(self):
+        if self._resume():
+            log.info('downloading %s packages', len(self._files))
+            self._target.StateChanged(mdvpkg.tasks.STATE_DOWNLOADING)
+            for (url, path, size) in self._files:
+                self._paths[os.path.basename(path)] = path
+                if mdvpkg.download.is_downloaded(path, size):
+                    self._start_verify(path)
+            if not self._failed:
+                self._downloading = True
+                self._download = self._downloader.fetch(self._files, self)
+        return False
+
+    def download_start(self, name):
+        self._target.DownloadStart(name)
+
+    def download_progress(self, name, done, total, speed):
+        if not self._resume():
+            self._download.cancel()
+            return
+        if total:
+            percent = done * 100 / total
+            eta = int((total - done) / max(speed, 1))
+        else:
+            percent = eta = 0
+        self._target.Download(name, str(percent), str(total), str(eta),
+                              str(int(speed)))
+
+    def download_done(self, name):
+        self._target.DownloadDone(name)
+        self._start_verify(self._paths[name])
+
+    def download_error(self, name, message):
+        self._target.DownloadError(name, message)
+        self._unverified = True
+
+    def downloads_finished(self, failed):
+        if failed:
+            log.warning('%s packages left for urpmi to download',
+                        len(failed))
+        self._downloading = False
+        self._install()
+        return False
+
+    def _start_verify(self, path):
+        key_ids = self._key_ids.get(path)
+        if self._verifier is None or not key_ids:
+            # urpmi checks the packages of medias without keys:
+            self._unverified = True
+        else:
+            self._verifying += 1
+            self._verifier.verify(path, key_ids, self._verified)
+
+    def _verified(self, path, error):
+        self._verifying -= 1
+        if error is None:
+            self._install()
+        elif not self._failed:
+            name = os.path.basename(path)
+            self._target.VerifyError(name, error)
+            # don't let urpmi use it:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self._failed = True
+            if self._download is not None:
+                self._download.cancel()
+            try:
+                self._monitor.send((mdvpkg.tasks.ERROR_VERIFY_FAILED,
+                                    '%s: %s' % (name, error)))
+            except StopIteration:
+                pass
+
+    def _install(self):
+        """Start the transaction once downloads and verifications are
+        done.
+        """
+        if self._downloading or self._verifying or not self._resume():
+            return
+        self._backend.install_packages(self._monitor,
+                                       self._target,
+                                       self._names,
+                                       verified=not self._unverified)
+
+
+class TaskScheduler(object):
+    """Queue of tasks ordered by priority class and sender.
+
+    Tasks of higher priority classes (lower values) are always taken
+    first.  Inside a priority class senders take turns, so a client
+    queueing many tasks doesn't starve the others, and each sender's
+    tasks are taken in the order they were queued.
+    """
+
+    def __init__(self):
+        # priority -> OrderedDict(sender -> deque of tasks), with
+        # senders in turn order:
+        self._classes = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, task):
+        senders = self._classes.setdefault(task.priority,
+                                           collections.OrderedDict())
+        senders.setdefault(task.sender, collections.deque()).append(task)
+        self._size += 1
+
+    def remove(self, task):
+        senders = self._classes[task.priority]
+        tasks = senders[task.sender]
+        tasks.remove(task)
+        if not tasks:
+            del senders[task.sender]
+        self._size -= 1
+
+    def pop(self):
+        """Remove and return the next task, raise KeyError if empty."""
+        for priority in sorted(self._classes):
+            senders = self._classes[priority]
+            if senders:
+                sender, tasks = senders.popitem(last=False)
+                task = tasks.popleft()
+                if tasks:
+                    # sender goes to the end of the turn:
+                    senders[sender] = tasks
+                self._size -= 1
+                return task
+        raise KeyError('pop from an empty scheduler')
+
+    def take(self, predicate):
+        """Remove and return the list of queued tasks for which
+        predicate is true, in the order they would be taken.
+        """
+        tasks = [ task for task in self.ordered() if predicate(task) ]
+        for task in tasks:
+            self.remove(task)
+        return tasks
+
+    def ordered(self):
+        """Return the list of queued tasks in the order they would be
+        taken.
+        """
+        ordered = []
+        for priority in sorted(self._classes):
+            turns = [ list(tasks)
+                          for tasks in self._classes[priority].itervalues() ]
+            while turns:
+                next_turns = []
+                for tasks in turns:
+                    ordered.append(tasks.pop(0))
+                    if tasks:
+                        next_turns.append(tasks)
+                turns = next_turns
+        return ordered
+
+
 class Runner(object):
     """Queue and controls the `run()` co-routine method of mdvpkg
-    tasks."""
+    tasks.
+
+    Tasks changing the system (i.e. using the backend) are run one at
+    a time in scheduler order (see TaskScheduler).  Read-only tasks
+    are run concurrently (up to max_readers), with their co-routine
+    steps interleaved in the main loop; they read from a snapshot of
+    the package cache, so cache updates don't change the data being
+    listed.
+
+    With merge_tasks, queued tasks of the same mergeable class are
+    run together in a single backend call (e.g. one urpmi transaction
+    for all queued installs).
 
-    def __init__(self, urpmi, backend_path):
+    With download_workers, packages to install are downloaded by the
+    daemon with as many concurrent downloads, and verified as they
+    arrive with up to verify_workers processes (see InstallPipeline).
+    """
+
+    def __init__(self, urpmi, backend_path, max_readers=MAX_READERS,
+                 progress_rate=DEFAULT_PROGRESS_RATE, merge_tasks=False,
+                 download_workers=0, verify_workers=None):
         self._urpmi = urpmi
-        self._backend = Backend(backend_path)
-        self.queue = collections.OrderedDict()
+        self._backend = Backend(backend_path, progress_rate)
+        self.queue = TaskScheduler()
+        self.read_queue = TaskScheduler()
+        self.max_readers = max_readers
+        self.merge_tasks = merge_tasks
+        self.resolutions = ResolutionCache()
+        if download_workers > 0:
+            self.downloader = mdvpkg.download.Downloader(download_workers)
+        else:
+            # urpmi downloads packages itself:
+            self.downloader = None
+        if verify_workers != 0:
+            self.verifier = mdvpkg.verify.Verifier(verify_workers)
+        else:
+            # urpmi verifies packages in the transaction:
+            self.verifier = None
         self.running = False
+        self.readers = set()
+        # running tasks sharing the backend call of the running slot:
+        self._merged = set()
+        self._scheduled = False
+        self._queued = {}  # queued task -> queue time
+        self._started = {}  # running task -> start time
+        self._estimates = {}  # task class name -> run time estimate
+        self._positions_scheduled = False
+        self._positions_time = 0.0  # last update of queue positions
+        urpmi.connect('media-changed', self._on_media_changed)
+
+    def start_backend(self):
+        """Pre-start the backend and keep it running, so tasks don't
+        wait for urpmi initialization.
+        """
+        self._backend.supervise()
+
+    def stop_backend(self):
+        """Stop the backend if it's running."""
+        if self._backend.running:
+            self._backend.kill()
 
     def push(self, task):
         """Add a task in the run queue."""
         log.debug('task queued: %s', task.path)
-        if not self.running:
-            self.run_next_task()
-        self.queue[task.path] = task
+        self._queued[task] = time.time()
+        self._queue_of(task).push(task)
         task.state = mdvpkg.tasks.STATE_QUEUED
+        self._update_positions()
+        self.run_next_task()
 
     def remove(self, task):
         """Remove a task in the queue."""
-        self.queue.pop(task.path)
+        self._queue_of(task).remove(task)
+        self._queued.pop(task, None)
+        self._update_positions()
 
     def run_next_task(self):
-        """Run next task in the next loop iteration."""
-        gobject.idle_add(self._run_next_task)
+        """Run next tasks in the next loop iteration."""
+        if not self._scheduled:
+            self._scheduled = True
+            gobject.idle_add(self._run_next_task)
+
+    def _on_media_changed(self, urpmi):
+        self._backend.reload()
+
+    def _queue_of(self, task):
+        if task.read_only:
+            return self.read_queue
+        return self.queue
 
     def _run_next_task(self):
-        """Get the next task in queue to run."""
-        try:
-            _, task = self.queue.popitem(last=False)
-        except KeyError:
+        """Start queued tasks while there are free slots."""
+        self._scheduled = False
+        while self.read_queue and len(self.readers) < self.max_readers:
+            task = self.read_queue.pop()
+            self.readers.add(task)
+            self._start_task(task)
+        while not self.running and self.queue:
+            task = self.queue.pop()
+            tasks = [task]
+            if self.merge_tasks and task.mergeable:
+                cls = task.__class__
+                tasks.extend(self.queue.take(lambda t: t.__class__ is cls
+                                                       and t.mergeable))
+            if len(tasks) > 1:
+                self._start_merged(tasks)
+            else:
+                self.running = True
+                self._start_task(task)
+        if not self.running and not self.readers:
             log.info('queue is empty, no more tasks to run')
-            self.running = False
+        self._update_positions()
+        return False
+
+    def _estimate(self, task):
+        """Estimated run time of a task."""
+        return self._estimates.get(task.__class__.__name__,
+                                   DEFAULT_RUN_ESTIMATE)
+
+    def _update_positions(self):
+        """Update queued tasks with their position and estimated wait
+        in the next loop iteration, or POSITIONS_INTERVAL after the
+        last update.
+        """
+        if self._positions_scheduled:
+            return
+        self._positions_scheduled = True
+        elapsed = (time.time() - self._positions_time) * 1000
+        gobject.timeout_add(int(max(0, POSITIONS_INTERVAL - elapsed)),
+                            self._send_positions)
+
+    def _send_positions(self):
+        self._positions_scheduled = False
+        now = self._positions_time = time.time()
+        for (queue, slots) in ((self.queue, 1),
+                               (self.read_queue, self.max_readers)):
+            if not queue:
+                continue
+            # remaining time of running tasks of this queue:
+            pending = 0.0
+            for (task, started) in self._started.iteritems():
+                if queue is self._queue_of(task):
+                    pending += max(0.0,
+                                   self._estimate(task) - (now - started))
+            for (position, task) in enumerate(queue.ordered()):
+                task.set_queue_position(position + 1,
+                                        int(round(pending / slots)))
+                pending += self._estimate(task)
+        return False
+
+    def _start_task(self, task):
+        self._task_started(task)
+        runner_gen = self._task_monitor(task)
+        try:
+            runner_gen.send(None)
+        except StopIteration:
+            log.error('task canceled while in queue and not removed')
         else:
-            self.running = True
-            task.state = mdvpkg.tasks.STATE_RUNNING
+            task.run(runner_gen, self._urpmi, self._backend)
+
+    def _start_merged(self, tasks):
+        """Start several tasks sharing a backend call."""
+        monitors = []
+        for task in tasks:
+            self._task_started(task)
             runner_gen = self._task_monitor(task)
             try:
                 runner_gen.send(None)
             except StopIteration:
                 log.error('task canceled while in queue and not removed')
             else:
-                task.run(runner_gen, self._urpmi, self._backend)
+                monitors.append((task, runner_gen))
+        if monitors:
+            log.info('running %s merged tasks: %s', len(monitors),
+                     ', '.join(task.path for (task, _) in monitors))
+            self.running = True
+            tasks = [ task for (task, _) in monitors ]
+            # the slot is freed when all of them are done:
+            self._merged = set(tasks)
+            router = SignalRouter(tasks)
+            group = MonitorGroup([ gen for (_, gen) in monitors ], router)
+            tasks[0].run_merged(group, router, self._urpmi, self._backend)
+
+    def _task_started(self, task):
+        now = self._started[task] = time.time()
+        mdvpkg.stats.observe('runner.queue_wait',
+                             now - self._queued.pop(task, now))
+        task.state = mdvpkg.tasks.STATE_RUNNING
+
+    def _task_done(self, task):
+        """Free the task slot and run next tasks."""
+        started = self._started.pop(task, None)
+        if started is not None:
+            name = task.__class__.__name__
+            run_time = time.time() - started
+            mdvpkg.stats.observe('runner.run_time.%s' % name, run_time)
+            if name in self._estimates:
+                run_time = (RUN_ESTIMATE_WEIGHT * run_time
+                                + (1 - RUN_ESTIMATE_WEIGHT)
+                                      * self._estimates[name])
+            self._estimates[name] = run_time
+        if task.read_only:
+            self.readers.discard(task)
+        elif task in self._merged:
+            self._merged.discard(task)
+            if not self._merged:
+                self.running = False
+        else:
+            self.running = False
+        if isinstance(task, mdvpkg.tasks.InstallPackagesTask):
+            # installed packages may not be in the package cache yet:
+            self.resolutions.clear()
+        self.run_next_task()
 
     def _task_monitor(self, task):
         """Return a generator to listen for task status in co-routine
@@ -199,6 +1096,7 @@ class Runner(object):
         StopIteration from our generator (which is thrown when the
         method returns).
         """
+        requeued = False
         while True:
             if task.canceled is True:
                 gobject.idle_add(task.on_cancel)
@@ -210,6 +1108,9 @@ class Runner(object):
                 task.state = mdvpkg.tasks.STATE_READY
                 task.on_ready()
                 break
+            except TaskRequeued:
+                requeued = True
+                break
             except Exception as e:
                 log.exception('task finished with exception')
                 task.on_exception(e.message)
@@ -218,4 +1119,8 @@ class Runner(object):
                 if error is not None:
                     task.on_error(*error)
                     break
-        self.run_next_task()
+        self._task_done(task)
+        if requeued:
+            # don't merge it again:
+            task.mergeable = False
+            self.push(task)